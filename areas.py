@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import minio
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import instrumentation
+import minio_communication
+import normalize
+from consts import *
+from election_data import DISTRICT_ID_COLUMN, VALID_VOTES_COLUMN, ElectionData, cached_election_data_path, load_cached
+from transform import districts_columns, load_districts
+
+
+LEVELS = ["gminas", "stations"]
+GMINA_COLUMN = 'TERYT gminy'
+STATION_COLUMN = 'Numer obwodu'
+
+# Names of the key columns in the raw files of different years
+KEY_COLUMN_NAMES = {
+    DISTRICT_ID_COLUMN: ['Numer okręgu', 'Okręg', 'Nr okręgu'],
+    GMINA_COLUMN: ['TERYT gminy', 'TERYT Gminy', 'Teryt Gminy', 'Teryt gminy', 'Kod TERYT'],
+    STATION_COLUMN: ['Numer obwodu', 'Nr komisji', 'Nr obwodu'],
+}
+LEVEL_KEYS = {
+    "gminas": [DISTRICT_ID_COLUMN, GMINA_COLUMN],
+    "stations": [DISTRICT_ID_COLUMN, GMINA_COLUMN, STATION_COLUMN],
+}
+
+
+def partition_obj_name(level: str, district: int) -> str:
+    return f"{level}/district={district:02d}/data.parquet"
+
+
+def manifest_obj_name(level: str) -> str:
+    return f"{level}/_manifest.json"
+
+
+def key_columns(header: List[str], level: str) -> Dict[str, str]:
+    """Raw name of every key column of the level."""
+    found = {}
+    for key in LEVEL_KEYS[level]:
+        names = [name for name in KEY_COLUMN_NAMES[key] if name in header]
+        if not names:
+            raise ValueError(f"No {key} column in {level} results, expected one of {KEY_COLUMN_NAMES[key]}")
+        found[key] = names[0]
+    return found
+
+
+def vote_columns(header: List[str]) -> List[str]:
+    return [name for name in header if name == VALID_VOTES_COLUMN or 'KOMITET' in name]
+
+
+def iter_area_chunks(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year: int, level: str) -> Iterator[pd.DataFrame]:
+    """Keys and votes of the areas of the level, chunk by chunk as the raw csv is parsed.
+
+    Only these columns are parsed, so the other columns of big raw files (addresses,
+    ballot counts) never take memory. Rows without a constituency are dropped.
+    """
+    found = {}
+
+    def select(header):
+        found.update(key_columns(header, level))
+        return list(found.values()) + vote_columns(header)
+
+    # Gmina codes keep their leading zeros
+    dtype = {
+        **{name: "float64" for name in KEY_COLUMN_NAMES[DISTRICT_ID_COLUMN] + KEY_COLUMN_NAMES[STATION_COLUMN]},
+        **{name: "string" for name in KEY_COLUMN_NAMES[GMINA_COLUMN]},
+    }
+    skipped = 0
+    for chunk in normalize.iter_csv_chunks(minio_client, bucket_configuration.raw_data_bucket, AREA_FILENAMES_BY_YEAR[year][level], select, dtype):
+        chunk = chunk.rename(columns={raw: key for (key, raw) in found.items()})
+        missing = chunk[DISTRICT_ID_COLUMN].isna()
+        skipped += int(missing.sum())
+        votes = [name for name in chunk.columns if name not in found]
+        yield chunk.loc[~missing].astype({
+            DISTRICT_ID_COLUMN: "int64",
+            **({STATION_COLUMN: "Int64"} if STATION_COLUMN in chunk else {}),
+            **{name: "float64" for name in votes},
+        })
+    if skipped:
+        print(f"{skipped} {level} rows of {year} without a constituency, skipping them")
+
+
+def aggregate_area_csv(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year: int, level: str) -> pd.DataFrame:
+    """Votes of the areas of the level summed to constituencies straight from the raw csv, chunk by chunk.
+
+    Memory depends on the number of constituencies, not of areas, so it works on files not partitioned yet.
+    """
+    found = {}
+
+    def select(header):
+        found.update(key_columns(header, level))
+        return [found[DISTRICT_ID_COLUMN]] + vote_columns(header)
+
+    dtype = {name: "float64" for name in KEY_COLUMN_NAMES[DISTRICT_ID_COLUMN]}
+    table = normalize.aggregate_csv_object(minio_client, bucket_configuration.raw_data_bucket, AREA_FILENAMES_BY_YEAR[year][level],
+                                           lambda columns: [found[DISTRICT_ID_COLUMN]], select, dtype)
+    table = table.rename(columns={found.get(DISTRICT_ID_COLUMN): DISTRICT_ID_COLUMN})
+    return table.astype({DISTRICT_ID_COLUMN: "int64", **{name: "float64" for name in table.columns if name != DISTRICT_ID_COLUMN}})
+
+
+def spool_districts(chunks: Iterator[pd.DataFrame], directory: str) -> Dict[int, str]:
+    """Rows of every constituency appended to its own parquet file in directory as chunks come.
+
+    Memory holds one chunk at a time, whatever the size of the raw file. Returns the file of every constituency.
+    """
+    writers: Dict[int, pq.ParquetWriter] = {}
+    paths = {}
+    try:
+        for chunk in chunks:
+            for (district, rows) in chunk.groupby(DISTRICT_ID_COLUMN, sort=False):
+                table = pa.Table.from_pandas(rows, preserve_index=False)
+                district = int(district)
+                if district not in writers:
+                    paths[district] = os.path.join(directory, f"{district}.parquet")
+                    writers[district] = pq.ParquetWriter(paths[district], table.schema)
+                writers[district].write_table(table.cast(writers[district].schema))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths
+
+
+def read_manifest(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, level: str) -> Optional[Dict]:
+    return minio_communication.read_json_object(minio_client, bucket_configuration.normalized_data_bucket, manifest_obj_name(level))
+
+
+def partition_year(minio_client: minio.Minio, year: int, level: str, force: bool = False) -> bool:
+    """Stores results of the level as one parquet file per constituency, rows sorted by gmina and station.
+
+    The manifest listing the partitions is written last and records the hash of the raw file,
+    unchanged files are skipped. Returns whether the partitions were written.
+    """
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    raw_name = AREA_FILENAMES_BY_YEAR[year][level]
+    metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.raw_data_bucket, raw_name)
+    if metadata is None:
+        print(f"No raw {level} for {year}, skipping")
+        return False
+    fingerprint = metadata.get("content-sha256", metadata.get("etag"))
+    manifest = read_manifest(minio_client, bucket_configuration, level)
+    if not force and manifest is not None and manifest["source-sha256"] == fingerprint:
+        print(f"Partitioned {level} for {year} are up to date, skipping")
+        return False
+
+    print(f"Partitioning {level} for {year}")
+    with instrumentation.span("partition", year=year, level=level) as span, tempfile.TemporaryDirectory() as directory:
+        # Rows are spooled to disk by constituency, then every partition is sorted on its own
+        spooled = spool_districts(iter_area_chunks(minio_client, bucket_configuration, year, level), directory)
+        minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.normalized_data_bucket)
+        partitions = {}
+        committies = []
+        with minio_communication.BatchWriter(minio_client) as writer:
+            for district in sorted(spooled):
+                rows = pq.read_table(spooled[district]).to_pandas()
+                rows = rows.astype({STATION_COLUMN: "Int64"} if STATION_COLUMN in rows else {})
+                rows = rows.sort_values(LEVEL_KEYS[level], ignore_index=True)
+                committies = [name for name in rows.columns if 'KOMITET' in name]
+                object_name = partition_obj_name(level, district)
+                data = normalize.to_parquet_bytes(normalize.normalize_frame(rows))
+                writer.submit([minio_communication.ObjectWrite(bucket_configuration.normalized_data_bucket, object_name, data,
+                                                               'application/vnd.apache.parquet', {"source-sha256": fingerprint})])
+                partitions[str(district)] = {"object": object_name, "rows": len(rows)}
+                span.add(rows=len(rows))
+
+        manifest = {
+            "source-sha256": fingerprint,
+            "level": level,
+            "keys": LEVEL_KEYS[level],
+            "committies": committies,
+            "partitions": partitions,
+        }
+        minio_communication.write_json_object(minio_client, bucket_configuration.normalized_data_bucket, manifest_obj_name(level), manifest)
+    return True
+
+
+def partition_years(minio_client: minio.Minio, years: List[int], levels: List[str] = LEVELS, force: bool = False) -> Dict[int, List[str]]:
+    return {year: [level for level in levels if partition_year(minio_client, year, level, force)] for year in years}
+
+
+def load_area(minio_client: minio.Minio, year: int, level: str, districts: Optional[List[int]] = None,
+              columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+    """Partitioned results of the level, only of the given constituencies and columns (keys are always read).
+
+    None if the level was not partitioned yet. Vote counts are floats with NaN where a committy did not run.
+    """
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    manifest = read_manifest(minio_client, bucket_configuration, level)
+    if manifest is None:
+        return None
+    wanted = manifest["partitions"] if districts is None else {str(district): manifest["partitions"][str(district)] for district in districts}
+    select = None if columns is None else (lambda names: [name for name in names if name in manifest["keys"] or name in columns])
+
+    def read(partition):
+        data = minio_communication.read_object_bytes(minio_client, bucket_configuration.normalized_data_bucket, partition["object"])
+        frame = normalize.read_parquet(data, select)
+        return frame.astype({STATION_COLUMN: "Int64"}) if STATION_COLUMN in frame else frame
+
+    with ThreadPoolExecutor(max_workers=minio_communication.get_upload_concurrency()) as pool:
+        frames = list(pool.map(read, wanted.values()))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=manifest["keys"])
+
+
+def aggregate(table: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+    """Sums of votes for every value of the by columns, NaN where a committy had no votes to count."""
+    return table.groupby(by, sort=True).sum(min_count=1, numeric_only=True).reset_index()
+
+
+def district_election_data(minio_client: minio.Minio, year: int, level: str = "stations") -> ElectionData:
+    """Election data of the constituencies summed from the results of the level.
+
+    Partitions are read if they are up to date, otherwise the raw csv is summed chunk by chunk.
+    Cached on disk like the data built from constituency results, by the hashes of both sources,
+    so jobs do not read the partitions again.
+    """
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    manifest = read_manifest(minio_client, bucket_configuration, level)
+    raw_metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.raw_data_bucket, AREA_FILENAMES_BY_YEAR[year][level])
+    if raw_metadata is None and manifest is None:
+        raise FileNotFoundError(f"No {level} results of {year}")
+    source = manifest["source-sha256"] if raw_metadata is None else raw_metadata.get("content-sha256", raw_metadata.get("etag"))
+    districts_metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year]["districts"]) or {}
+    identity = [year, level, source, districts_metadata.get("content-sha256", districts_metadata.get("etag"))]
+    fingerprint = hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+    cached = load_cached(year, fingerprint)
+    if cached is not None:
+        return cached
+
+    if manifest is not None and manifest["source-sha256"] == source:
+        results = aggregate(load_area(minio_client, year, level, columns=[VALID_VOTES_COLUMN] + manifest["committies"]), [DISTRICT_ID_COLUMN])
+    else:
+        print(f"{level} of {year} are not partitioned, summing the raw file")
+        results = aggregate_area_csv(minio_client, bucket_configuration, year, level)
+    districts = load_districts(minio_client, bucket_configuration, year, lambda columns: districts_columns(year, columns))
+    district_ids = sorted(districts[DISTRICT_ID_COLUMN].tolist())
+    if results[DISTRICT_ID_COLUMN].tolist() != district_ids:
+        raise ValueError(f"{level} of {year} do not cover the {len(district_ids)} constituencies of its districts file")
+    # Joined by constituency number, which need not run from 1 without gaps
+    joined = districts.set_index(DISTRICT_ID_COLUMN).join(results.set_index(DISTRICT_ID_COLUMN).fillna(0))
+    data = ElectionData.from_frame(year, joined)
+    return data.save(cached_election_data_path(year, fingerprint))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, nargs='+', choices=YEARS, default=YEARS,
+                        help='years to partition')
+    parser.add_argument('--level', type=str, nargs='+', choices=LEVELS, default=LEVELS,
+                        help='levels of results to partition')
+    parser.add_argument('--force', action='store_true',
+                        help='partition again even if raw files did not change')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    minio_client = minio_communication.get_client()
+    with instrumentation.instrumented(program_args, "areas"):
+        partition_years(minio_client, list(dict.fromkeys(program_args.year)), list(dict.fromkeys(program_args.level)), program_args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import timeit
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import minio_communication
+from consts import *
+from DivisorMethods import runDHondt, runSainteLague
+from storage import InMemoryStorage
+
+
+PARTY_COUNTS = [2, 5, 10, 20, 50]
+SEAT_COUNTS = [1, 10, 100, 1000]
+FIXTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wykaz_list_sejm_2023.csv")
+DEFAULT_TOLERANCE = 0.2
+
+
+def fixture_frames(year: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Raw results and districts frames in the layout of the given year, built from the bundled 2023 list results.
+
+    Both years hold the 2023 votes, only the column layout follows the year,
+    which is what the loaders and the transforms depend on.
+    """
+    lists = pd.read_csv(FIXTURE_FILE, sep=";", encoding="utf-8-sig")
+    votes = lists.pivot_table(index='Numer okręgu', columns='Nazwa Komitetu', values='Liczba głosów', aggfunc='sum')
+    seats = lists.groupby('Numer okręgu')['Liczba mandatów'].sum()
+
+    leading = RESULTS_FIRST_COLUMN_BY_YEAR[year]
+    results = pd.DataFrame({f"column {i}": np.arange(len(votes)) for i in range(leading)})
+    results['Liczba głosów ważnych oddanych łącznie na wszystkie listy kandydatów'] = votes.sum(axis=1).astype(np.int64).to_numpy()
+    for committy in votes.columns:
+        results[committy] = votes[committy].to_numpy()
+
+    columns = {
+        'Numer okręgu': votes.index.to_numpy(),
+        'Liczba mandatów': seats.to_numpy(),
+        'Siedziba OKW': [f"Siedziba {id}" for id in votes.index],
+        'Opis granic': [f"Granice {id}" for id in votes.index],
+    }
+    # Positions of the columns used by transform.districts_columns
+    positions = DISTRICTS_COLUMNS_BY_YEAR[year]
+    layout = [f"column {i}" for i in range(8)]
+    for (position, name) in zip(positions, columns):
+        layout[position] = name
+    districts = pd.DataFrame({name: columns.get(name, np.zeros(len(votes), dtype=np.int64)) for name in layout})
+    return (results, districts)
+
+
+def fixture_client(years: List[int]) -> InMemoryStorage:
+    """In-memory storage holding the raw files of the fixture years."""
+    client = InMemoryStorage()
+    for year in years:
+        bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+        client.make_bucket(bucket_configuration.raw_data_bucket)
+        for (kind, frame) in zip(["results", "districts"], fixture_frames(year)):
+            data = frame.to_csv(sep=";", index=False).encode("utf-8")
+            client.put_object(bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year][kind], io.BytesIO(data), len(data))
+    return client
+
+
+def measure(function: Callable[[], Any], repeat: int = 3, min_time: float = 0.2) -> Dict[str, float]:
+    """Best time of one call over repeat rounds, each round running at least min_time."""
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = [elapsed] + timer.repeat(repeat=repeat - 1, number=number) if repeat > 1 else [elapsed]
+    return {"seconds": min(times) / number, "calls": number * len(times)}
+
+
+def divisor_benchmarks() -> Dict[str, Callable[[], Any]]:
+    rnd = random.Random(0)
+    benchmarks = {}
+    for parties in PARTY_COUNTS:
+        data = [(f"party {i}", rnd.randint(1_000, 2_000_000)) for i in range(parties)]
+        for seats in SEAT_COUNTS:
+            benchmarks[f"divisor/dhondt/parties={parties}/seats={seats}"] = (lambda data=data, seats=seats: runDHondt(data, seats))
+            benchmarks[f"divisor/sainte-lague/parties={parties}/seats={seats}"] = (lambda data=data, seats=seats: runSainteLague(data, seats))
+    return benchmarks
+
+
+def calculate_benchmarks(years: List[int]) -> Dict[str, Callable[[], Any]]:
+    from transform import calculate_method, expand_methods, prepare_election_data
+
+    benchmarks = {}
+    for year in years:
+        data = prepare_election_data(year, *fixture_frames(year))
+        for method in expand_methods(["all"]):
+            benchmarks[f"calculate/{year}/{method}"] = (lambda data=data, method=method: calculate_method(method, data))
+    return benchmarks
+
+
+def pipeline_benchmarks(years: List[int]) -> Dict[str, Callable[[], Any]]:
+    """Load from the raw files, calculate every method and save, with the election data cache cleared before each run."""
+    import transform
+
+    clients = {year: fixture_client([year]) for year in years}
+
+    def run(year):
+        client = clients[year]
+        with tempfile.TemporaryDirectory() as cache:
+            previous = os.environ.get("ELECTION_DATA_CACHE")
+            os.environ["ELECTION_DATA_CACHE"] = cache
+            try:
+                transform.run_year(client, year, transform.expand_methods(["all"]))
+            finally:
+                if previous is None:
+                    del os.environ["ELECTION_DATA_CACHE"]
+                else:
+                    os.environ["ELECTION_DATA_CACHE"] = previous
+
+    return {f"pipeline/{year}": (lambda year=year: run(year)) for year in years}
+
+
+def run_benchmarks(selected: Optional[str], years: List[int], repeat: int, min_time: float) -> Dict[str, Any]:
+    benchmarks = {**divisor_benchmarks(), **calculate_benchmarks(years), **pipeline_benchmarks(years)}
+    results = {}
+    for (name, function) in benchmarks.items():
+        if selected is not None and selected not in name:
+            continue
+        # Transform prints progress on every job, it is not part of the measurement
+        stdout, sys.stdout = (sys.stdout, io.StringIO())
+        try:
+            result = measure(function, repeat, min_time)
+        finally:
+            sys.stdout = stdout
+        print(f"{name}: {result['seconds'] * 1000:.3f} ms")
+        results[name] = result
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Prints time ratios of benchmarks present in both runs, returns names slower than baseline by more than tolerance."""
+    regressions = []
+    for (name, result) in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name}: new, {result['seconds'] * 1000:.3f} ms")
+            continue
+        before = baseline["results"][name]["seconds"]
+        ratio = result["seconds"] / before
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = "  faster"
+        print(f"{name}: {before * 1000:.3f} ms -> {result['seconds'] * 1000:.3f} ms ({ratio:.2f}x){flag}")
+    return regressions
+
+
+def read_json(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run benchmarks and write their results as JSON')
+    run.add_argument('--output', type=str, default='benchmark.json',
+                     help='file for the results')
+    run.add_argument('--baseline', type=str, default=None,
+                     help='results of an earlier run to compare with')
+    run.add_argument('--filter', type=str, default=None,
+                     help='only benchmarks whose name contains this text')
+    run.add_argument('--year', type=int, nargs='+', choices=YEARS, default=YEARS,
+                     help='fixture years of the calculate and pipeline benchmarks')
+    run.add_argument('--repeat', type=int, default=3,
+                     help='rounds of every benchmark, the best one counts')
+    run.add_argument('--min-time', type=float, default=0.2,
+                     help='minimal duration of a round in seconds')
+    run.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                     help='relative slowdown reported as a regression')
+
+    comparison = commands.add_parser('compare', help='compare two result files')
+    comparison.add_argument('baseline', type=str)
+    comparison.add_argument('current', type=str)
+    comparison.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                            help='relative slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+
+    if program_args.command == 'run':
+        current = run_benchmarks(program_args.filter, program_args.year, program_args.repeat, program_args.min_time)
+        with open(program_args.output, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        if program_args.baseline is None:
+            return
+        baseline = read_json(program_args.baseline)
+    else:
+        baseline, current = (read_json(program_args.baseline), read_json(program_args.current))
+
+    regressions = compare(baseline, current, program_args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {program_args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,14 @@ YEARS = [2019, 2023]
 LINKS_BY_YEAR = {
     2019: [
         "https://wybory.gov.pl/sejmsenat2019/data/csv/okregi_sejm_csv.zip",
-        "http://wybory.gov.pl/sejmsenat2019/data/csv/wyniki_gl_na_listy_po_okregach_sejm_csv.zip"],
+        "http://wybory.gov.pl/sejmsenat2019/data/csv/wyniki_gl_na_listy_po_okregach_sejm_csv.zip",
+        "http://wybory.gov.pl/sejmsenat2019/data/csv/wyniki_gl_na_listy_po_gminach_sejm_csv.zip",
+        "http://wybory.gov.pl/sejmsenat2019/data/csv/wyniki_gl_na_listy_po_obwodach_sejm_csv.zip"],
     2023: [
         "http://wybory.gov.pl/sejmsenat2023/data/csv/okregi_sejm_csv.zip",
-        "http://wybory.gov.pl/sejmsenat2023/data/csv/wyniki_gl_na_listy_po_okregach_sejm_csv.zip"
+        "http://wybory.gov.pl/sejmsenat2023/data/csv/wyniki_gl_na_listy_po_okregach_sejm_csv.zip",
+        "http://wybory.gov.pl/sejmsenat2023/data/csv/wyniki_gl_na_listy_po_gminach_sejm_csv.zip",
+        "http://wybory.gov.pl/sejmsenat2023/data/csv/wyniki_gl_na_listy_po_obwodach_sejm_csv.zip"
     ]
 }
 
@@ -21,8 +25,59 @@ FILENAMES_BY_YEAR = {
     }
 }
 
+# Results of smaller areas, stored partitioned by constituency instead of as one normalized file
+AREA_FILENAMES_BY_YEAR = {
+    2019: {
+        "gminas": "wyniki_gl_na_listy_po_gminach_sejm.csv",
+        "stations": "wyniki_gl_na_listy_po_obwodach_sejm.csv"
+    },
+    2023: {
+        "gminas": "wyniki_gl_na_listy_po_gminach_sejm_utf8.csv",
+        "stations": "wyniki_gl_na_listy_po_obwodach_sejm_utf8.csv"
+    }
+}
+
+# Layout of the raw files: first column of the results used (the total of valid votes),
+# and positions of the number, seats, seat and description columns of the constituencies
+RESULTS_FIRST_COLUMN_BY_YEAR = {
+    2019: 23,
+    2023: 25
+}
+
+DISTRICTS_COLUMNS_BY_YEAR = {
+    2019: [1, 2, 6, 0],
+    2023: [0, 1, 5, 6]
+}
+
+NORMALIZED_FILENAMES = {
+    "results": "results.parquet",
+    "districts": "districts.parquet"
+}
+
+# US House and presidential results, kept in the repository
+US_YEARS = [2024]
+
+US_FILENAMES_BY_YEAR = {
+    2024: {
+        "house": "US2024/house2024.csv",
+        "president": "US2024/2024president.csv"
+    }
+}
+
+US_HOUSE_SEATS = 435
+US_SENATORS_PER_STATE = 2
+US_DC_ELECTORS = 3
+
 MINIO_DEFAULT_SERVER_URL = "localhost:9000"
 MINIO_DEFAULT_USER = "admin"
 MINIO_DEFAULT_PASSWORD = "adminadmin"
+MINIO_DEFAULT_POOL_SIZE = 32
+MINIO_DEFAULT_CONNECT_TIMEOUT = 10
+MINIO_DEFAULT_READ_TIMEOUT = 120
+MINIO_DEFAULT_RETRIES = 5
+MINIO_DEFAULT_UPLOAD_CONCURRENCY = 8
+
+STORAGE_DEFAULT_BACKEND = "minio"
+STORAGE_DEFAULT_PATH = ".storage-data"
 
 CONSTITUENCIES = 41
\ No newline at end of file
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+
+from consts import *
+from lazy_import import lazy_import
+
+# Only needed to build election data from tables
+pd = lazy_import("pandas")
+
+
+SEATS_COLUMN = 'Liczba mandatów'
+VALID_VOTES_COLUMN = 'Liczba głosów ważnych oddanych łącznie na wszystkie listy kandydatów'
+DISTRICT_NAME_COLUMN = 'Siedziba OKW'
+DISTRICT_ID_COLUMN = 'Numer okręgu'
+
+ARRAYS = ["district_ids", "seats", "valid_votes", "votes"]
+METADATA_FILE = "metadata.json"
+
+
+def cache_dir() -> str:
+    return os.environ.get("ELECTION_DATA_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "elections"))
+
+
+@dataclasses.dataclass(frozen=True)
+class Committy:
+    name: str
+    coalition: bool
+    minority: bool
+
+    @staticmethod
+    def from_name(name: str) -> "Committy":
+        return Committy(name, 'KOALICYJNY' in name, 'MNIEJSZOŚĆ' in name)
+
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class ElectionData:
+    """Results of one election, constituencies in rows and committies in columns.
+
+    Arrays of data loaded from the cache are read-only memory maps, so processes
+    sharing the cache directory read the same pages instead of own copies.
+    """
+    year: int
+    committies: List[Committy]
+    district_ids: np.ndarray
+    district_names: List[str]
+    district_descriptions: List[str]
+    description_column: str
+    seats: np.ndarray
+    valid_votes: np.ndarray
+    votes: np.ndarray
+    path: Optional[str] = None
+
+    @staticmethod
+    def from_frame(year: int, ed: pd.DataFrame) -> "ElectionData":
+        """Builds election data from the frame of transform.join_election_data."""
+        rows = ed.loc[ed.index != 'sum']
+        names = [ele for ele in list(ed.columns) if 'KOMITET' in ele]
+        description_column = [ele for ele in ed.columns[:3] if ele not in (SEATS_COLUMN, DISTRICT_NAME_COLUMN)][0]
+        return ElectionData(
+            year=year,
+            committies=[Committy.from_name(name) for name in names],
+            district_ids=rows.index.to_numpy(dtype=np.int64),
+            district_names=[str(name) for name in rows[DISTRICT_NAME_COLUMN]],
+            district_descriptions=[str(description) for description in rows[description_column]],
+            description_column=description_column,
+            seats=rows[SEATS_COLUMN].to_numpy(dtype=np.int64),
+            valid_votes=np.rint(rows[VALID_VOTES_COLUMN].to_numpy(dtype=float)).astype(np.int64),
+            votes=np.rint(rows[names].fillna(0).to_numpy(dtype=float)).astype(np.int64),
+        )
+
+    @property
+    def committy_names(self) -> List[str]:
+        return [committy.name for committy in self.committies]
+
+    def committy_index(self, name: str) -> int:
+        return self.committy_names.index(name)
+
+    @property
+    def total_seats(self) -> int:
+        return int(self.seats.sum())
+
+    @property
+    def total_valid_votes(self) -> int:
+        return int(self.valid_votes.sum())
+
+    def national_votes(self) -> np.ndarray:
+        return self.votes.sum(axis=0)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Election data as a frame indexed by constituency number with a national 'sum' row."""
+        ed = pd.DataFrame({
+            SEATS_COLUMN: self.seats,
+            DISTRICT_NAME_COLUMN: self.district_names,
+            self.description_column: self.district_descriptions,
+            VALID_VOTES_COLUMN: self.valid_votes,
+        }, index=pd.Index(self.district_ids, name=DISTRICT_ID_COLUMN))
+        ed = ed.join(pd.DataFrame(self.votes.astype(float), index=ed.index, columns=self.committy_names))
+        sums = ed.sum(numeric_only=True)
+        ed.loc['sum'] = {**sums.to_dict(), DISTRICT_NAME_COLUMN: "", self.description_column: ""}
+        return ed.astype({SEATS_COLUMN: np.int64, VALID_VOTES_COLUMN: np.int64})
+
+    def save(self, path: str) -> "ElectionData":
+        """Writes the data to a cache directory, returns it loaded back from there."""
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix=".staging-")
+        try:
+            for name in ARRAYS:
+                np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+            metadata = {
+                "year": self.year,
+                "committies": [dataclasses.asdict(committy) for committy in self.committies],
+                "district_names": self.district_names,
+                "district_descriptions": self.district_descriptions,
+                "description_column": self.description_column,
+            }
+            with open(os.path.join(staging, METADATA_FILE), "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False)
+            os.rename(staging, path)
+        except OSError:
+            # Another process saved the same data first
+            if not os.path.exists(os.path.join(path, METADATA_FILE)):
+                raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return ElectionData.load(path)
+
+    @staticmethod
+    def load(path: str) -> "ElectionData":
+        with open(os.path.join(path, METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in ARRAYS}
+        return ElectionData(
+            year=metadata["year"],
+            committies=[Committy(**committy) for committy in metadata["committies"]],
+            district_names=metadata["district_names"],
+            district_descriptions=metadata["district_descriptions"],
+            description_column=metadata["description_column"],
+            path=path,
+            **arrays,
+        )
+
+    # Data from the cache travels to other processes as its path only
+    def __reduce_ex__(self, protocol):
+        if self.path is not None:
+            return (ElectionData.load, (self.path,))
+        return super().__reduce_ex__(protocol)
+
+
+def cached_election_data_path(year: int, fingerprint: str) -> str:
+    return os.path.join(cache_dir(), f"{year}-{fingerprint}")
+
+
+def load_cached(year: int, fingerprint: str) -> Optional[ElectionData]:
+    path = cached_election_data_path(year, fingerprint)
+    if not os.path.exists(os.path.join(path, METADATA_FILE)):
+        return None
+    return ElectionData.load(path)
@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+
+
+METRICS_FORMATS = ["jsonl", "prometheus"]
+PROMETHEUS_PREFIX = "elections"
+TOP_ALLOCATIONS = 20
+# Span attributes summed in the Prometheus metrics, others only label the JSON lines
+COUNTERS = ["bytes", "rows", "members", "uploaded", "methods", "outdated"]
+
+
+class Span:
+    """Timed stage of a run, numeric attributes like bytes or rows are summed in the metrics."""
+    __slots__ = ("name", "attributes", "start", "parent")
+
+    def __init__(self, name: str, attributes: Dict[str, Any], parent: Optional[str]) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.start = time.perf_counter()
+
+    def add(self, **attributes) -> None:
+        for (key, value) in attributes.items():
+            if isinstance(value, (int, float)) and isinstance(self.attributes.get(key), (int, float)):
+                value += self.attributes[key]
+            self.attributes[key] = value
+
+
+class _NoSpan:
+    """Span used while instrumentation is off, doing nothing."""
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+    def add(self, **attributes) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class JsonLinesSink:
+    """Writes every finished span as one JSON line."""
+
+    def __init__(self, path: str) -> None:
+        # Line buffered, so forked worker processes do not inherit and write again unflushed lines
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        self.lock = threading.Lock()
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class PrometheusSink:
+    """Sums spans by name and writes them in the Prometheus text format when closed."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.gauges: Dict[str, float] = {}
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        with self.lock:
+            if record.get("type") == "memory":
+                self.gauges["memory_peak_bytes"] = record["peak_bytes"]
+                return
+            name = record["span"]
+            self.counts[name] += 1
+            self.totals[name]["seconds"] += record["seconds"]
+            for key in COUNTERS:
+                if key in record:
+                    self.totals[name][key] += record[key]
+
+    def close(self) -> None:
+        lines = [f"# TYPE {PROMETHEUS_PREFIX}_span_count counter"]
+        lines += [f'{PROMETHEUS_PREFIX}_span_count{{span="{name}"}} {count}' for (name, count) in sorted(self.counts.items())]
+        for key in sorted({key for totals in self.totals.values() for key in totals}):
+            metric = f"{PROMETHEUS_PREFIX}_span_{key}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines += [f'{metric}{{span="{name}"}} {totals[key]}' for (name, totals) in sorted(self.totals.items()) if key in totals]
+        for (name, value) in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name} {value}")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class ListSink:
+    """Keeps records in memory, used in worker processes to send them back with the job result."""
+
+    def __init__(self) -> None:
+        self.records: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        with self.lock:
+            self.records.append(record)
+
+    def drain(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            records, self.records = (self.records, [])
+        return records
+
+    def close(self) -> None:
+        pass
+
+
+_sink = None
+_stack = threading.local()
+
+
+def enabled() -> bool:
+    return _sink is not None
+
+
+def span(name: str, **attributes):
+    """Context manager timing a stage; when instrumentation is off it is a shared object doing nothing."""
+    if _sink is None:
+        return _NO_SPAN
+    return _timed(name, attributes)
+
+
+@contextlib.contextmanager
+def _timed(name: str, attributes: Dict[str, Any]) -> Iterator[Span]:
+    stack = _stack.__dict__.setdefault("spans", [])
+    current = Span(name, attributes, stack[-1].name if stack else None)
+    stack.append(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        # Spans of generators may end out of order
+        stack.remove(current)
+        seconds = time.perf_counter() - current.start
+        record = {
+            "span": name,
+            "start": time.time() - seconds,
+            "seconds": seconds,
+            "parent": current.parent,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            **current.attributes,
+        }
+        if error is not None:
+            record["error"] = error
+        sink = _sink
+        if sink is not None:
+            sink.emit(record)
+
+
+def emit(records: List[Dict[str, Any]]) -> None:
+    """Records spans finished elsewhere, like in worker processes."""
+    if _sink is not None:
+        for record in records:
+            _sink.emit(record)
+
+
+def collect_in_worker() -> None:
+    """Turns instrumentation on in a worker process, keeping spans for drain()."""
+    global _sink
+    _sink = ListSink()
+
+
+def drain() -> List[Dict[str, Any]]:
+    """Spans finished in this worker process since the last call."""
+    return _sink.drain() if isinstance(_sink, ListSink) else []
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='file for timings of the run stages, instrumentation is off without it')
+    parser.add_argument('--metrics-format', type=str, choices=METRICS_FORMATS, default="jsonl",
+                        help='JSON line per span or summed Prometheus text')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='file for cProfile statistics of the whole run')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='record peak memory and top allocations with tracemalloc')
+
+
+@contextlib.contextmanager
+def instrumented(program_args: argparse.Namespace, name: str) -> Iterator[None]:
+    """Runs the body as one span named after the program, set up from the add_arguments options."""
+    global _sink
+    if program_args.metrics is not None:
+        _sink = PrometheusSink(program_args.metrics) if program_args.metrics_format == "prometheus" else JsonLinesSink(program_args.metrics)
+    profiler = cProfile.Profile() if program_args.profile is not None else None
+    if program_args.trace_memory:
+        tracemalloc.start()
+
+    try:
+        if profiler is not None:
+            profiler.enable()
+        with span(name):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(program_args.profile)
+        if program_args.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            top = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+            record = {
+                "type": "memory",
+                "peak_bytes": peak,
+                "top": [{"where": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in top],
+            }
+            if _sink is not None:
+                _sink.emit(record)
+            else:
+                print(f"Peak traced memory: {peak} bytes")
+        if _sink is not None:
+            _sink.close()
+            _sink = None
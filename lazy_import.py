@@ -0,0 +1,29 @@
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+
+_lock = threading.Lock()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Module executed on first attribute access, so imports only cost when they are used.
+
+    Modules already imported are returned as they are. Only top level modules can be lazy,
+    finding a submodule imports its package.
+    """
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
+
@@ -1,9 +1,22 @@
+from __future__ import annotations
+
 import dataclasses
+import io
+import json
 import os
+import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
-import minio
-
+import instrumentation
 from consts import *
+from lazy_import import lazy_import
+
+# Imported on first use, so command line help and validation start fast
+minio = lazy_import("minio")
+urllib3 = lazy_import("urllib3")
+storage = lazy_import("storage")
 
 
 def _get_minio_endpoint_str() -> str:
@@ -18,29 +31,192 @@ def _get_minio_secret_key() -> str:
     secret = os.environ.get("MINIO_SECRET_KEY", MINIO_DEFAULT_PASSWORD)
     return secret
 
+def _get_minio_pool_size() -> int:
+    return int(os.environ.get("MINIO_POOL_SIZE", MINIO_DEFAULT_POOL_SIZE))
+
+def _get_minio_timeout() -> urllib3.Timeout:
+    return urllib3.Timeout(connect=float(os.environ.get("MINIO_CONNECT_TIMEOUT", MINIO_DEFAULT_CONNECT_TIMEOUT)),
+                           read=float(os.environ.get("MINIO_READ_TIMEOUT", MINIO_DEFAULT_READ_TIMEOUT)))
+
+def _get_minio_retries() -> urllib3.Retry:
+    return urllib3.Retry(total=int(os.environ.get("MINIO_RETRIES", MINIO_DEFAULT_RETRIES)),
+                         backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+
+def get_upload_concurrency() -> int:
+    return int(os.environ.get("MINIO_UPLOAD_CONCURRENCY", MINIO_DEFAULT_UPLOAD_CONCURRENCY))
+
+# Buckets known to exist, for every client
+_known_buckets: "weakref.WeakKeyDictionary[minio.Minio, set]" = weakref.WeakKeyDictionary()
+_known_buckets_lock = threading.Lock()
+
 def create_bucket_if_not_exist(minio_client: minio.Minio, minio_bucket_name: str):
+    """Creates the bucket if missing, asking the server only the first time for every client."""
+    with _known_buckets_lock:
+        known = _known_buckets.setdefault(minio_client, set())
+        if minio_bucket_name in known:
+            return
     if not minio_client.bucket_exists(minio_bucket_name):
-        minio_client.make_bucket(minio_bucket_name)
+        try:
+            minio_client.make_bucket(minio_bucket_name)
+        except minio.error.S3Error as e:
+            # Created by another writer in the meantime
+            if e.code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
+    with _known_buckets_lock:
+        known.add(minio_bucket_name)
 
 def upload_file(minio_client: minio.Minio, minio_bucket_name: str, object_name: str, filepath_local: str):
     minio_client.fput_object(minio_bucket_name, object_name, filepath_local)
 
-def get_client() -> minio.Minio:
+def get_object_metadata(minio_client: minio.Minio, minio_bucket_name: str, object_name: str) -> Optional[Dict[str, str]]:
+    """User metadata of an object without the x-amz-meta- prefix, None if the object does not exist."""
+    try:
+        stat = minio_client.stat_object(minio_bucket_name, object_name)
+    except minio.error.S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchBucket", "NoSuchObject"):
+            return None
+        raise
+    metadata = {key.lower(): value for (key, value) in (stat.metadata or {}).items()}
+    metadata = {key[len("x-amz-meta-"):]: value for (key, value) in metadata.items() if key.startswith("x-amz-meta-")}
+    metadata.setdefault("etag", stat.etag)
+    return metadata
+
+def read_object_bytes(minio_client: minio.Minio, minio_bucket_name: str, object_name: str) -> Optional[bytes]:
+    """Reads whole object, None if it does not exist."""
+    with instrumentation.span("minio.get_object", bucket=minio_bucket_name, object=object_name) as span:
+        try:
+            response = minio_client.get_object(minio_bucket_name, object_name)
+        except minio.error.S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchBucket", "NoSuchObject"):
+                return None
+            raise
+        try:
+            data = response.read()
+            span.add(bytes=len(data))
+            return data
+        finally:
+            response.close()
+            response.release_conn()
+
+def read_json_object(minio_client: minio.Minio, minio_bucket_name: str, object_name: str) -> Optional[Dict[str, Any]]:
+    """Reads JSON object, None if it does not exist."""
+    data = read_object_bytes(minio_client, minio_bucket_name, object_name)
+    return None if data is None else json.loads(data)
+
+def object_exists(minio_client: minio.Minio, minio_bucket_name: str, object_name: str) -> bool:
+    return get_object_metadata(minio_client, minio_bucket_name, object_name) is not None
+
+def list_object_names(minio_client: minio.Minio, minio_bucket_name: str, prefix: Optional[str] = None) -> List[str]:
+    """Names of all objects of the bucket starting with prefix, empty if the bucket does not exist."""
+    if not minio_client.bucket_exists(minio_bucket_name):
+        return []
+    return [obj.object_name for obj in minio_client.list_objects(minio_bucket_name, prefix=prefix, recursive=True)]
+
+def put_bytes(minio_client: minio.Minio, minio_bucket_name: str, object_name: str, data: bytes,
+              content_type: str = "application/octet-stream", metadata: Optional[Dict[str, str]] = None) -> None:
+    with instrumentation.span("minio.put_object", bucket=minio_bucket_name, object=object_name, bytes=len(data)):
+        minio_client.put_object(minio_bucket_name, object_name, io.BytesIO(data), len(data), content_type=content_type, metadata=metadata)
+
+def write_json_object(minio_client: minio.Minio, minio_bucket_name: str, object_name: str, value: Dict[str, Any]) -> None:
+    put_bytes(minio_client, minio_bucket_name, object_name, json.dumps(value).encode("utf-8"), "application/json")
+
+# Client of the current process, forked processes build their own instead of sharing its sockets
+_client: Optional[minio.Minio] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+def new_client() -> storage.Storage:
+    """Client of the storage backend chosen by STORAGE_BACKEND.
+
+    MinIO clients get their own connection pool, sized for concurrent uploads, with timeouts
+    and retries of server errors. The local backend keeps buckets in STORAGE_PATH, the in-memory
+    one lives only as long as the process.
+    """
+    backend = storage.get_storage_backend()
+    if backend == "local":
+        return storage.LocalStorage(storage.get_storage_path())
+    if backend == "memory":
+        return storage.InMemoryStorage()
+
+    http_client = urllib3.PoolManager(
+        maxsize=_get_minio_pool_size(),
+        timeout=_get_minio_timeout(),
+        retries=_get_minio_retries(),
+    )
     return minio.Minio(
         _get_minio_endpoint_str(),
         access_key=_get_minio_access_key(),
         secret_key=_get_minio_secret_key(),
         secure=False,
+        http_client=http_client,
     )
 
+def get_client() -> storage.Storage:
+    """Client shared by the whole process, connections are reused between calls."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client, _client_pid = (new_client(), os.getpid())
+        return _client
+
+
+@dataclasses.dataclass(frozen=True)
+class ObjectWrite:
+    bucket_name: str
+    object_name: str
+    data: bytes
+    content_type: str = "application/octet-stream"
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchWriter:
+    """Uploads groups of objects concurrently, the objects of one group in order.
+
+    Later objects of a group may mark the earlier ones as complete (results tagged with the
+    fingerprint of their inputs), so a group stops at its first failure. The other groups go on,
+    failures are raised together by close.
+    """
+
+    def __init__(self, minio_client: minio.Minio, concurrency: Optional[int] = None) -> None:
+        self.minio_client = minio_client
+        self.pool = ThreadPoolExecutor(max_workers=concurrency or get_upload_concurrency())
+        self.uploads: List[Future] = []
+
+    def _write(self, writes: List[ObjectWrite]) -> None:
+        for write in writes:
+            put_bytes(self.minio_client, write.bucket_name, write.object_name, write.data, write.content_type, write.metadata)
+
+    def submit(self, writes: List[ObjectWrite]) -> Future:
+        upload = self.pool.submit(self._write, list(writes))
+        self.uploads.append(upload)
+        return upload
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+        errors = [upload.exception() for upload in self.uploads if upload.exception() is not None]
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(self.uploads)} uploads failed") from errors[0]
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Keeps the original error, uploads already submitted still finish
+            self.pool.shutdown(wait=True)
+
 
 @dataclasses.dataclass(frozen=True)
 class MinioBucketConfigurationForYear:
     raw_data_bucket: str
+    normalized_data_bucket: str
     transformed_data_bucket: str
 
 def get_minio_bucket_configuration(year: int) -> MinioBucketConfigurationForYear:
     return MinioBucketConfigurationForYear(
         raw_data_bucket="raw-data-{}".format(year),
+        normalized_data_bucket="normalized-data-{}".format(year),
         transformed_data_bucket="transformed-data-{}".format(year)
     )
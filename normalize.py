@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import io
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Union
+
+import minio
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import instrumentation
+import minio_communication
+from consts import *
+
+
+PARQUET_COMPRESSION = "zstd"
+# Rows of a csv parsed at once by the streaming reader, bounds its memory with the selected columns
+CSV_CHUNK_ROWS = 100_000
+CSV_SEPARATOR = ";"
+
+
+def normalized_obj_name(kind: str) -> str:
+    return NORMALIZED_FILENAMES[kind]
+
+
+def normalize_frame(df: pd.DataFrame) -> pa.Table:
+    """Typed table of a raw csv frame.
+
+    Float columns holding only whole numbers are counts with missing values (committies not running
+    in a constituency), they are stored as nullable integers. Texts are dictionary encoded by parquet.
+    """
+    columns = {}
+    for name in df.columns:
+        column = df[name]
+        if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+            column = column.astype("Int64")
+        columns[name] = column
+    return pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+
+
+def to_parquet_bytes(table: pa.Table) -> bytes:
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=PARQUET_COMPRESSION)
+    return buffer.getvalue()
+
+
+def read_parquet(data: bytes, select: Optional[Callable[[List[str]], List[str]]] = None) -> pd.DataFrame:
+    """Reads parquet bytes, only the columns chosen by select from all column names if given.
+
+    Nullable integers come back as floats with NaN, the same as pd.read_csv gives for the raw files.
+    """
+    with instrumentation.span("read_parquet", bytes=len(data)) as span:
+        parquet_file = pq.ParquetFile(io.BytesIO(data))
+        columns = None if select is None else select(parquet_file.schema_arrow.names)
+        df = parquet_file.read(columns=columns).to_pandas()
+        span.add(rows=len(df))
+    nullable = [name for name in df.columns if isinstance(df[name].dtype, pd.Int64Dtype)]
+    return df.astype({name: "float64" for name in nullable})
+
+
+class CsvStream:
+    """Object response read by the csv parser, with the header line taken out first and counting bytes."""
+
+    def __init__(self, response: BinaryIO) -> None:
+        self.response = response
+        self.buffer = b""
+        self.bytes = 0
+
+    def _raw_read(self, size: int) -> bytes:
+        data = self.response.read(size)
+        self.bytes += len(data)
+        return data
+
+    def header(self) -> List[str]:
+        """Column names, the header stays in the stream for the parser."""
+        while b"\n" not in self.buffer:
+            data = self._raw_read(64 * 1024)
+            if not data:
+                break
+            self.buffer += data
+        line = self.buffer.split(b"\n", 1)[0].decode("utf-8-sig").rstrip("\r")
+        return next(csv.reader([line], delimiter=CSV_SEPARATOR), [])
+
+    def read(self, size: int = -1) -> bytes:
+        if self.buffer:
+            data = self.buffer if size is None or size < 0 else self.buffer[:size]
+            self.buffer = self.buffer[len(data):]
+            return data
+        return self._raw_read(-1 if size is None else size)
+
+
+def iter_csv_chunks(minio_client: minio.Minio, bucket_name: str, object_name: str,
+                    select: Optional[Callable[[List[str]], List[str]]] = None, dtype: Optional[Union[str, Dict[str, str]]] = None,
+                    chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Frames of consecutive rows of a csv object, parsed while it is downloaded.
+
+    Only the columns chosen by select from all column names are parsed, with the given dtypes;
+    memory use depends on chunk_rows and the selected columns, not on the object size.
+    """
+    with instrumentation.span("read_csv", bucket=bucket_name, object=object_name) as span:
+        response = minio_client.get_object(bucket_name, object_name)
+        try:
+            stream = CsvStream(response)
+            header = stream.header()
+            selected = header if select is None else select(header)
+            wanted = set(selected)
+            positions = [i for (i, name) in enumerate(header) if name in wanted]
+            reader = pd.read_csv(stream, sep=CSV_SEPARATOR, usecols=positions, dtype=dtype, chunksize=chunk_rows)
+            with reader:
+                for chunk in reader:
+                    span.add(rows=len(chunk))
+                    yield chunk[selected] if list(chunk.columns) != list(selected) else chunk
+            span.add(bytes=stream.bytes)
+        finally:
+            response.close()
+            response.release_conn()
+
+
+def read_csv_object(minio_client: minio.Minio, bucket_name: str, object_name: str,
+                    select: Optional[Callable[[List[str]], List[str]]] = None, dtype: Optional[Union[str, Dict[str, str]]] = None) -> pd.DataFrame:
+    """Whole csv object, only the columns chosen by select from all column names."""
+    chunks = list(iter_csv_chunks(minio_client, bucket_name, object_name, select, dtype))
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+
+
+def aggregate_csv_object(minio_client: minio.Minio, bucket_name: str, object_name: str, by: Union[List[str], Callable[[List[str]], List[str]]],
+                         select: Optional[Callable[[List[str]], List[str]]] = None, dtype: Optional[Union[str, Dict[str, str]]] = None,
+                         chunk_rows: int = CSV_CHUNK_ROWS) -> pd.DataFrame:
+    """Sums of the selected columns of a csv object for every value of the by columns, computed chunk by chunk.
+
+    by may also choose the columns from the selected ones, for files naming them differently.
+    Meant for files too big to load, like results by polling station summed to constituencies:
+    memory depends on the number of groups, not of rows. Sums of groups without any value stay NaN,
+    rows without a value of the by columns are left out.
+    """
+    total = None
+    for chunk in iter_csv_chunks(minio_client, bucket_name, object_name, select, dtype, chunk_rows):
+        if callable(by):
+            by = by(list(chunk.columns))
+        partial = chunk.groupby(by, sort=False).sum(min_count=1, numeric_only=True)
+        total = partial if total is None else total.add(partial, fill_value=0)
+    if total is None:
+        return pd.DataFrame(columns=by)
+    return total.sort_index().reset_index()
+
+
+def load_raw_csv(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year: int, kind: str,
+                 select: Optional[Callable[[List[str]], List[str]]] = None, dtype: Optional[Union[str, Dict[str, str]]] = None) -> pd.DataFrame:
+    return read_csv_object(minio_client, bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year][kind], select, dtype)
+
+
+def load_normalized(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, kind: str,
+                    select: Optional[Callable[[List[str]], List[str]]] = None) -> Optional[pd.DataFrame]:
+    """Normalized frame of the given kind, None if the year was not normalized yet."""
+    data = minio_communication.read_object_bytes(minio_client, bucket_configuration.normalized_data_bucket, normalized_obj_name(kind))
+    if data is None:
+        return None
+    return read_parquet(data, select)
+
+
+def source_fingerprint(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year: int, kind: str) -> Optional[str]:
+    metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year][kind])
+    if metadata is None:
+        return None
+    return metadata.get("content-sha256", metadata.get("etag"))
+
+
+def normalize_year(minio_client: minio.Minio, year: int, force: bool = False) -> List[str]:
+    """Converts raw csv files of a year to parquet in its normalized bucket.
+
+    Files whose raw source did not change since they were normalized are skipped.
+    Returns kinds of the written files.
+    """
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.normalized_data_bucket)
+
+    written = []
+    for kind in FILENAMES_BY_YEAR[year]:
+        fingerprint = source_fingerprint(minio_client, bucket_configuration, year, kind)
+        if fingerprint is None:
+            print(f"No raw {kind} for {year}, skipping")
+            continue
+        stored = minio_communication.get_object_metadata(minio_client, bucket_configuration.normalized_data_bucket, normalized_obj_name(kind))
+        if not force and stored is not None and stored.get("source-sha256") == fingerprint:
+            print(f"Normalized {kind} for {year} is up to date, skipping")
+            continue
+
+        print(f"Normalizing {kind} for {year}")
+        with instrumentation.span("normalize", year=year, kind=kind):
+            data = to_parquet_bytes(normalize_frame(load_raw_csv(minio_client, bucket_configuration, year, kind)))
+            with instrumentation.span("minio.put_object", bucket=bucket_configuration.normalized_data_bucket, object=normalized_obj_name(kind), bytes=len(data)):
+                minio_client.put_object(bucket_configuration.normalized_data_bucket, normalized_obj_name(kind),
+                                        io.BytesIO(data), len(data), content_type="application/vnd.apache.parquet",
+                                        metadata={"source-sha256": fingerprint})
+        written.append(kind)
+    return written
+
+
+def normalize_years(minio_client: minio.Minio, years: List[int], force: bool = False) -> Dict[int, List[str]]:
+    return {year: normalize_year(minio_client, year, force) for year in years}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, nargs='+', choices=YEARS, default=YEARS,
+                        help='years to normalize')
+    parser.add_argument('--force', action='store_true',
+                        help='normalize again even if raw files did not change')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    minio_client = minio_communication.get_client()
+    with instrumentation.instrumented(program_args, "normalize"):
+        normalize_years(minio_client, list(dict.fromkeys(program_args.year)), program_args.force)
+
+
+if __name__ == "__main__":
+    main()
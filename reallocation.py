@@ -0,0 +1,180 @@
+from math import inf
+import random
+
+import numpy as np
+
+from DivisorMethods import HUNTINGTON_HILL, SAINTE_LAGUE, apportion, divisor_table, get_divisor_sequence
+
+
+HARE_NIEMEYER = "hare-niemeyer"
+
+# Divisor sequence of every rule, None for the largest remainder
+RULES = {
+    HARE_NIEMEYER: None,
+    SAINTE_LAGUE.name: SAINTE_LAGUE,
+    HUNTINGTON_HILL.name: HUNTINGTON_HILL,
+}
+
+
+def _as_batch(bases, seats):
+    bases = np.asarray(bases)
+    if bases.ndim != 2:
+        raise ValueError(f"bases must be a scenarios x districts matrix, got shape {bases.shape}")
+    seats = np.broadcast_to(np.asarray(seats, dtype=np.int64), bases.shape[:1]).copy()
+    if (bases < 0).any() or (bases.sum(axis=1) <= 0).any():
+        raise ValueError("bases must be non-negative with a positive total in every scenario")
+    return (bases, seats)
+
+
+def _exact_integers(bases, seats):
+    """Integer bases if products with seats fit int64, None otherwise."""
+    if not np.issubdtype(bases.dtype, np.integer):
+        if not (np.isfinite(bases).all() and (bases == np.floor(bases)).all()):
+            return None
+    if float(bases.sum(axis=1).max()) * max(int(seats.max(initial=0)), 1) >= 2 ** 62:
+        return None
+    return bases.astype(np.int64)
+
+
+def largest_remainder_batch(bases, seats) -> np.ndarray:
+    """Hare-Niemeyer: lower quota for every district, the rest to the largest remainders.
+
+    Integer bases are handled with integer arithmetic, so equal remainders are really equal;
+    ties go to the bigger district and then to the district listed first.
+    Returns the scenarios x districts seat matrix.
+    """
+    bases, seats = _as_batch(bases, seats)
+    districts = bases.shape[1]
+    integers = _exact_integers(bases, seats)
+
+    if integers is not None:
+        totals = integers.sum(axis=1, keepdims=True)
+        scaled = integers * seats[:, None]
+        lower, remainders = (scaled // totals, scaled % totals)
+        key = integers
+    else:
+        bases = bases.astype(float)
+        quotas = bases * (seats / bases.sum(axis=1))[:, None]
+        lower = np.floor(quotas).astype(np.int64)
+        remainders = quotas - lower
+        key = bases
+
+    left = seats - lower.sum(axis=1)
+    index = np.broadcast_to(np.arange(districts), bases.shape)
+    order = np.lexsort((index, -key, -remainders), axis=-1)
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, index, axis=-1)
+    return lower + (rank < left[:, None])
+
+
+def _priorities(bases, divisors, held):
+    """Quotients bases / d(held), infinite for a zero divisor."""
+    divisor = divisors[held]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quotients = bases / divisor
+    quotients[divisor == 0] = inf
+    return quotients
+
+
+def divisor_reallocation_batch(bases, seats, method = SAINTE_LAGUE, max_iterations = None) -> np.ndarray:
+    """Divisor method reallocation, starting from the quota rounded by the divisors and moving one seat per iteration.
+
+    Every iteration adds the strongest next seat where seats are missing, removes the weakest held
+    seat where there are too many, and otherwise swaps them if the next seat beats the held one.
+    Quotients are ordered like in DivisorMethods.apportion: bigger district first, then the one listed first.
+    Scenarios leave the loop as soon as they settle; RuntimeError is raised if some do not settle
+    in max_iterations (by default twice the number of districts).
+    Returns the scenarios x districts seat matrix.
+    """
+    method = get_divisor_sequence(method)
+    bases, seats = _as_batch(bases, seats)
+    bases = bases.astype(float)
+    scenarios, districts = bases.shape
+    max_iterations = 2 * districts + 2 if max_iterations is None else max_iterations
+
+    quotas = bases * (seats / bases.sum(axis=1))[:, None]
+    divisors = divisor_table(method, int(seats.max(initial=0)) + 2)
+    # Divisors grow by a constant step, a quota above d(s) / step is rounded to more than s seats
+    step = divisors[-1] - divisors[-2]
+    held = np.minimum(np.searchsorted(divisors, quotas * step, side='right'), seats[:, None])
+    index = np.arange(districts)
+
+    active = np.arange(scenarios)
+    for _ in range(max_iterations):
+        rows = bases[active]
+        row_held = held[active]
+        next_seat = _priorities(rows, divisors, row_held)
+        held_seat = np.where(row_held > 0, _priorities(rows, divisors, np.maximum(row_held - 1, 0)), inf)
+
+        tie_index = np.broadcast_to(index, rows.shape)
+        best = np.lexsort((tie_index, -rows, -next_seat), axis=-1)[:, 0]
+        # Districts without seats are never the weakest, also when the weakest held seat is infinite (Huntington-Hill)
+        worst = np.lexsort((-tie_index, rows, held_seat, row_held == 0), axis=-1)[:, 0]
+
+        picked = np.arange(len(active))
+        best_key = (next_seat[picked, best], rows[picked, best], -best)
+        worst_key = (held_seat[picked, worst], rows[picked, worst], -worst)
+        beats = (best_key[0] > worst_key[0]) | ((best_key[0] == worst_key[0]) & (
+            (best_key[1] > worst_key[1]) | ((best_key[1] == worst_key[1]) & (best_key[2] > worst_key[2]))))
+        # Only happens when no district holds a seat, there is nothing to swap
+        beats &= row_held[picked, worst] > 0
+
+        missing = seats[active] - row_held.sum(axis=1)
+        add = (missing > 0) | ((missing == 0) & beats)
+        remove = (missing < 0) | ((missing == 0) & beats)
+        if not (add | remove).any():
+            return held
+
+        held[active[add], best[add]] += 1
+        held[active[remove], worst[remove]] -= 1
+        active = active[add | remove]
+
+    raise RuntimeError(f"{method.name} reallocation did not settle in {max_iterations} iterations for {len(active)} scenarios")
+
+
+def reallocate_batch(bases, seats, rule = HARE_NIEMEYER, max_iterations = None) -> np.ndarray:
+    """Reallocates seats among districts proportionally to their population or number of voters.
+
+    bases is a scenarios x districts matrix, so many hypothetical populations are reallocated
+    in one batch with the rule named in RULES.
+    """
+    if rule not in RULES:
+        raise NotImplementedError(rule)
+    if RULES[rule] is None:
+        return largest_remainder_batch(bases, seats)
+    return divisor_reallocation_batch(bases, seats, RULES[rule], max_iterations)
+
+
+def reallocate(bases, seats, rule = HARE_NIEMEYER) -> np.ndarray:
+    """Reallocates seats among districts of a single scenario."""
+    return reallocate_batch(np.asarray(bases)[None, :], seats, rule)[0]
+
+
+def test(trials = 500, seed = 0):
+    """Checks the batch rules against the scalar apportionment on random, also tied, bases."""
+    rnd = random.Random(seed)
+    for trial in range(trials):
+        districts = rnd.randint(1, 12)
+        bases = [rnd.choice([rnd.randint(1, 100), rnd.randint(1, 10 ** 6), 60, 120]) for _ in range(districts)]
+        seats = rnd.randint(districts, 60)
+        names = list(range(districts))
+
+        # Fewer seats than districts leave some without a seat, Huntington-Hill gives the first seats to the biggest
+        for rule_seats in [seats, rnd.randint(0, districts - 1)]:
+            for rule in [SAINTE_LAGUE, HUNTINGTON_HILL]:
+                expected = [held for (_, held) in apportion(list(zip(names, bases)), rule_seats, rule)[0]]
+                got = divisor_reallocation_batch([bases], rule_seats, rule)[0].tolist()
+                assert got == expected, (trial, rule, bases, rule_seats, got, expected)
+
+        got = largest_remainder_batch([bases], seats)[0]
+        total = sum(bases)
+        lower = [base * seats // total for base in bases]
+        remainders = sorted(names, key=lambda i: (-(bases[i] * seats % total), -bases[i], i))
+        expected = [lower[i] + (i in remainders[:seats - sum(lower)]) for i in names]
+        assert got.tolist() == expected, (trial, bases, seats, got, expected)
+
+    print(f"{trials} random reallocations agree with the scalar rules")
+
+
+if __name__ == "__main__":
+    test()
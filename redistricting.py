@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import minio_communication
+from consts import *
+from DivisorMethods import DIVISOR_SEQUENCES, DHONDT, apportion_batch, get_divisor_sequence
+from election_data import ElectionData
+from reallocation import HARE_NIEMEYER, reallocate_batch
+from thresholds import ThresholdRule
+from transform import OUTPUT_FORMATS, load_election_data, write_df_to_minio
+
+
+@dataclasses.dataclass(frozen=True)
+class DistrictMap:
+    """Alternative district map: new district of every constituency and seats of every new district.
+
+    national_seats are allocated on national votes in addition to the districts, as a national tier.
+    """
+    name: str
+    assignment: np.ndarray
+    magnitudes: np.ndarray
+    national_seats: int = 0
+
+    def __post_init__(self):
+        assignment = np.asarray(self.assignment, dtype=np.int64)
+        magnitudes = np.asarray(self.magnitudes, dtype=np.int64)
+        if (assignment < 0).any() or (assignment >= len(magnitudes)).any():
+            raise ValueError(f"{self.name}: districts must be numbered from 0 to {len(magnitudes) - 1}")
+        if (magnitudes < 0).any() or self.national_seats < 0:
+            raise ValueError(f"{self.name}: seats must be non-negative")
+        empty = np.setdiff1d(np.flatnonzero(magnitudes), assignment)
+        if len(empty):
+            raise ValueError(f"{self.name}: districts {empty.tolist()} have seats but no constituencies")
+        object.__setattr__(self, "assignment", assignment)
+        object.__setattr__(self, "magnitudes", magnitudes)
+
+    @property
+    def districts(self) -> int:
+        return len(self.magnitudes)
+
+    @property
+    def total_seats(self) -> int:
+        return int(self.magnitudes.sum()) + self.national_seats
+
+
+def current_map(data: ElectionData) -> DistrictMap:
+    return DistrictMap("current", np.arange(len(data.seats)), np.array(data.seats))
+
+
+def national_map(data: ElectionData, regional_seats: int = 0) -> DistrictMap:
+    """Single national list; with regional_seats the constituencies keep that many seats, split by the current
+    magnitudes, and the rest is a national tier."""
+    if regional_seats == 0:
+        return DistrictMap("national", np.zeros(len(data.seats), dtype=np.int64), np.array([data.total_seats]))
+    magnitudes = reallocate_batch(np.array(data.seats)[None, :], regional_seats, HARE_NIEMEYER)[0]
+    return DistrictMap(f"national-{regional_seats}-regional", np.arange(len(data.seats)), magnitudes,
+                       data.total_seats - regional_seats)
+
+
+def merged_map(data: ElectionData, groups: Sequence[Sequence[int]], name: Optional[str] = None) -> DistrictMap:
+    """Merges each group of constituency numbers into one district keeping the sum of their seats."""
+    ids = {int(id): position for (position, id) in enumerate(data.district_ids)}
+    group_of = {ids[int(id)]: number for (number, group) in enumerate(groups) for id in group}
+    assignment, magnitudes = (np.empty(len(ids), dtype=np.int64), [])
+    labels = {}
+    for position in range(len(ids)):
+        key = ("group", group_of[position]) if position in group_of else ("single", position)
+        if key not in labels:
+            labels[key] = len(labels)
+            magnitudes.append(0)
+        assignment[position] = labels[key]
+        magnitudes[labels[key]] += int(data.seats[position])
+    return DistrictMap(name or f"merged-{len(groups)}", assignment, np.array(magnitudes))
+
+
+def proportional_magnitudes(data: ElectionData, assignment, seats: int, rule: str = HARE_NIEMEYER) -> np.ndarray:
+    """Magnitudes of the districts of an assignment proportional to their valid votes."""
+    assignment = np.asarray(assignment)
+    valid_votes = np.bincount(assignment, weights=data.valid_votes, minlength=assignment.max() + 1)
+    return reallocate_batch(valid_votes[None, :], seats, rule)[0]
+
+
+def aggregate_votes(votes, assignments, districts: int) -> np.ndarray:
+    """Sums constituency votes into the districts of every map.
+
+    This is the product of a sparse maps * districts x constituencies 0/1 matrix with the
+    constituencies x committies vote matrix, done as one weighted bincount per committy.
+    Returns the maps x districts x committies vote tensor.
+    """
+    votes = np.asarray(votes, dtype=float)
+    assignments = np.asarray(assignments, dtype=np.int64)
+    maps, constituencies = assignments.shape
+    rows = (assignments + districts * np.arange(maps)[:, None]).ravel()
+    aggregated = np.empty((maps * districts, votes.shape[1]))
+    for committy in range(votes.shape[1]):
+        weights = np.broadcast_to(votes[:, committy], (maps, constituencies)).ravel()
+        aggregated[:, committy] = np.bincount(rows, weights=weights, minlength=maps * districts)
+    return aggregated.reshape(maps, districts, votes.shape[1])
+
+
+def qualifying(data: ElectionData, rule: ThresholdRule) -> np.ndarray:
+    """Mask of committies passing the rule on national votes."""
+    shares = 100 * data.national_votes() / data.total_valid_votes
+    return shares >= np.array([rule.threshold(committy) for committy in data.committies])
+
+
+def evaluate_maps(data: ElectionData, maps: List[DistrictMap], method = DHONDT,
+                  rule: ThresholdRule = ThresholdRule()) -> np.ndarray:
+    """Seats of every committy under every map, as a maps x committies matrix.
+
+    Maps are padded to the same number of districts with empty ones, so the whole batch is
+    one aggregation and one apportion_batch call (plus one for national tiers).
+    """
+    method = get_divisor_sequence(method)
+    passing = qualifying(data, rule)
+    votes = np.asarray(data.votes, dtype=float)[:, passing]
+    seats = np.zeros((len(maps), len(data.committies)), dtype=np.int64)
+    if not len(maps) or not passing.any():
+        return seats
+
+    districts = max(district_map.districts for district_map in maps)
+    assignments = np.stack([district_map.assignment for district_map in maps])
+    magnitudes = np.zeros((len(maps), districts), dtype=np.int64)
+    for (i, district_map) in enumerate(maps):
+        magnitudes[i, :district_map.districts] = district_map.magnitudes
+
+    aggregated = aggregate_votes(votes, assignments, districts)
+    district_seats = apportion_batch(aggregated.reshape(-1, votes.shape[1]), magnitudes.ravel(), method)
+    won = district_seats.reshape(len(maps), districts, -1).sum(axis=1)
+
+    national_seats = np.array([district_map.national_seats for district_map in maps])
+    if national_seats.any():
+        national_votes = np.broadcast_to(votes.sum(axis=0), (len(maps), votes.shape[1]))
+        won += apportion_batch(national_votes, national_seats, method)
+
+    seats[:, passing] = won
+    return seats
+
+
+def gallagher_index(seats, votes) -> np.ndarray:
+    """Least squares disproportionality of every row of seats against national vote shares, in percent."""
+    seats = np.asarray(seats, dtype=float)
+    votes = np.asarray(votes, dtype=float)
+    seat_shares = 100 * seats / seats.sum(axis=-1, keepdims=True)
+    vote_shares = 100 * votes / votes.sum()
+    return np.sqrt(((seat_shares - vote_shares) ** 2).sum(axis=-1) / 2)
+
+
+def outcomes_table(data: ElectionData, maps: List[DistrictMap], seats: np.ndarray, method_name: str) -> pd.DataFrame:
+    """Tidy table of map outcomes, one row for every map and committy."""
+    comitties = data.committy_names
+    disproportionality = gallagher_index(seats, data.national_votes())
+    return pd.DataFrame({
+        'method': method_name,
+        'map': np.repeat([district_map.name for district_map in maps], len(comitties)),
+        'districts': np.repeat([int((district_map.magnitudes > 0).sum()) for district_map in maps], len(comitties)),
+        'national seats': np.repeat([district_map.national_seats for district_map in maps], len(comitties)),
+        'gallagher index': np.repeat(disproportionality, len(comitties)),
+        'party': np.tile(comitties, len(maps)),
+        'seats': seats.ravel(),
+    })
+
+
+def map_from_dict(data: ElectionData, spec: Dict[str, Any]) -> DistrictMap:
+    """Map described as {"name", "districts": [[constituency numbers], ...], "magnitudes": [...] or
+    "proportional", "national_seats"}; constituencies missing from districts stay on their own."""
+    district_map = merged_map(data, spec.get("districts", []), spec.get("name"))
+    magnitudes = spec.get("magnitudes")
+    national_seats = int(spec.get("national_seats", 0))
+    if magnitudes == "proportional":
+        magnitudes = proportional_magnitudes(data, district_map.assignment, data.total_seats - national_seats,
+                                             spec.get("rule", HARE_NIEMEYER))
+    elif magnitudes is None:
+        magnitudes = district_map.magnitudes
+    return DistrictMap(district_map.name, district_map.assignment, np.asarray(magnitudes), national_seats)
+
+
+def redistricting_obj_name(output_format: str = "csv") -> str:
+    return f"redistricting.{output_format}"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, choices=YEARS, default=2023,
+                        help='year to analyze')
+    parser.add_argument('--maps', type=str, default=None,
+                        help='JSON file with a list of maps, see map_from_dict')
+    parser.add_argument('--regional-seats', type=int, nargs='*', default=[],
+                        help='also evaluate a national list keeping that many seats in constituencies')
+    parser.add_argument('--method', type=str, choices=list(DIVISOR_SEQUENCES), default=DHONDT.name,
+                        help='divisor method used in every district')
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default="csv",
+                        help='format of the outcomes table')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    minio_client = minio_communication.get_client()
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(program_args.year)
+    data = load_election_data(minio_client, program_args.year)
+
+    maps = [current_map(data), national_map(data)]
+    maps += [national_map(data, regional_seats) for regional_seats in program_args.regional_seats]
+    if program_args.maps is not None:
+        with open(program_args.maps, encoding="utf-8") as f:
+            maps += [map_from_dict(data, spec) for spec in json.load(f)]
+
+    print(f"Evaluating {len(maps)} maps for {program_args.year}")
+    seats = evaluate_maps(data, maps, program_args.method)
+    table = outcomes_table(data, maps, seats, program_args.method)
+
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+    write_df_to_minio(minio_client, bucket_configuration.transformed_data_bucket, redistricting_obj_name(program_args.output_format),
+                      table, program_args.output_format)
+
+
+if __name__ == "__main__":
+    main()
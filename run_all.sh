@@ -5,7 +5,7 @@ APPORTIONMENTS=(
     global-dhondt global-sainte-lague 
     global-dhondt-no-threshold global-sainte-lague-no-threshold 
     constituencial-dhondt-no-threshold constituencial-sainte-lague-no-threshold 
-    squared-dhondt fair-vote-weight-dhondt
+    squared-dhondt fair-vote-weight-dhondt vote-weight-dhondt
 )
 YEARS=(2019 2023)
 
@@ -19,14 +19,8 @@ echo "Starting Minio..."
 echo "Scraping..."
 ./scrape.py
 
-for year in "${YEARS[@]}"
-do
-    for apportionment in "${APPORTIONMENTS[@]}"
-    do
-        echo "Running transform for $year $apportionment"
-        ./transform.py --year $year --apportionment $apportionment
-    done
-done
+echo "Running transforms..."
+./transform.py --year "${YEARS[@]}" --apportionment "${APPORTIONMENTS[@]}" --workers "$(nproc)"
 
 echo "Stopping Minio..."
 ./stop_minio.sh
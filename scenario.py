@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+import hashlib
+import io
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import minio
+import pandas as pd
+
+import areas
+import instrumentation
+import minio_communication
+import normalize
+import scrape
+from consts import *
+from thresholds import ThresholdRule, sweep, sweep_methods, threshold_grid, threshold_range
+from transform import (
+    ALL_METHODS, CONSTITUENCIES_LEVEL, DATA_LEVELS, OUTPUT_FORMATS, expand_methods, inputs_fingerprint, load_election_data,
+    pending_methods, run_parallel, run_year, select_method, seats_obj_name, write_df_to_minio,
+)
+
+
+STAGES = ["ingest", "normalize", "apportion", "thresholds", "report"]
+NODE_STATES = ["done", "up to date", "failed", "skipped"]
+
+
+@dataclasses.dataclass(frozen=True)
+class ElectionSpec:
+    """Election of a scenario; its key names the buckets ("raw-data-{key}") and cached data.
+
+    Elections known to consts need only their year, others give the links of their archives,
+    names of the raw files and their layout. With a level of areas votes of the constituencies
+    are summed from results by gmina or polling station, named in files too for other elections.
+    """
+    key: Union[int, str]
+    links: List[str]
+    files: Dict[str, str]
+    results_first_column: int
+    districts_columns: List[int]
+    area_files: Dict[str, str] = dataclasses.field(default_factory=dict)
+    level: str = CONSTITUENCIES_LEVEL
+
+    @staticmethod
+    def from_dict(entry: Dict[str, Any]) -> "ElectionSpec":
+        key = entry.get("name", entry.get("year"))
+        if key is None:
+            raise ValueError(f"Election without a name or year: {entry}")
+        layout = entry.get("layout", {})
+        files = dict(entry.get("files", FILENAMES_BY_YEAR.get(key, {})))
+        area_files = {**AREA_FILENAMES_BY_YEAR.get(key, {}), **{level: files.pop(level) for level in DATA_LEVELS if level in files}}
+        if set(files) != {"results", "districts"}:
+            raise ValueError(f"Election {key} needs files of its results and districts")
+        level = entry.get("level", CONSTITUENCIES_LEVEL)
+        if level not in DATA_LEVELS:
+            raise ValueError(f"Level of election {key} must be one of {DATA_LEVELS}, got {level}")
+        if level != CONSTITUENCIES_LEVEL and level not in area_files:
+            raise ValueError(f"Election {key} needs a file of its {level} results")
+        return ElectionSpec(
+            key=key,
+            links=list(entry.get("sources", LINKS_BY_YEAR.get(key, []))),
+            files=dict(files),
+            results_first_column=int(layout.get("results_first_column", RESULTS_FIRST_COLUMN_BY_YEAR.get(key, RESULTS_FIRST_COLUMN_BY_YEAR[2023]))),
+            districts_columns=[int(i) for i in layout.get("districts_columns", DISTRICTS_COLUMNS_BY_YEAR.get(key, DISTRICTS_COLUMNS_BY_YEAR[2023]))],
+            area_files=area_files,
+            level=level,
+        )
+
+    def register(self) -> None:
+        """Makes the election known to the loaders, which look raw files and layouts up by its key."""
+        if self.key not in YEARS:
+            YEARS.append(self.key)
+        LINKS_BY_YEAR[self.key] = self.links
+        FILENAMES_BY_YEAR[self.key] = self.files
+        RESULTS_FIRST_COLUMN_BY_YEAR[self.key] = self.results_first_column
+        DISTRICTS_COLUMNS_BY_YEAR[self.key] = self.districts_columns
+        if self.area_files:
+            AREA_FILENAMES_BY_YEAR[self.key] = self.area_files
+
+
+def threshold_values(value: Any, default: float) -> List[float]:
+    """Thresholds given as a list or as a range {start, stop, step}."""
+    if value is None:
+        return [default]
+    if isinstance(value, dict):
+        return threshold_range(value["start"], value["stop"], value["step"])
+    return [float(threshold) for threshold in value]
+
+
+@dataclasses.dataclass(frozen=True)
+class Scenario:
+    elections: List[ElectionSpec]
+    methods: List[str]
+    threshold_rules: List[ThresholdRule]
+    output_format: str = "csv"
+    report_bucket: Optional[str] = None
+    report_object: str = "scenario-report"
+    workers: int = 1
+    jobs: int = os.cpu_count() or 1
+    force: bool = False
+
+    @staticmethod
+    def from_dict(config: Dict[str, Any]) -> "Scenario":
+        elections = [ElectionSpec.from_dict(entry) for entry in config.get("elections", [])]
+        if not elections:
+            raise ValueError("Scenario without elections")
+        keys = [election.key for election in elections]
+        if len(set(keys)) != len(keys):
+            raise ValueError(f"Elections of a scenario need different names, got {keys}")
+        methods = expand_methods(config.get("methods", [ALL_METHODS]))
+        for method in methods:
+            select_method(method)
+
+        rules = []
+        if config.get("thresholds"):
+            grid = config["thresholds"]
+            rules = threshold_grid(threshold_values(grid.get("regular"), 5), threshold_values(grid.get("coalition"), 8),
+                                   threshold_values(grid.get("minority"), 0))
+        outputs = config.get("outputs", {})
+        run = config.get("run", {})
+        output_format = outputs.get("format", "csv")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Output format must be one of {OUTPUT_FORMATS}, got {output_format}")
+        return Scenario(
+            elections=elections,
+            methods=methods,
+            threshold_rules=rules,
+            output_format=output_format,
+            report_bucket=outputs.get("bucket"),
+            report_object=outputs.get("report", "scenario-report"),
+            workers=int(run.get("workers", 1)),
+            jobs=int(run.get("jobs", os.cpu_count() or 1)),
+            force=bool(run.get("force", False)),
+        )
+
+    def threshold_methods(self) -> List[str]:
+        """Methods of the scenario swept over the thresholds, those supporting batches with their own thresholds."""
+        return [method for method in self.methods if method in sweep_methods([ALL_METHODS])]
+
+
+def load_scenario(path: str) -> Scenario:
+    """Scenario from a YAML file, or TOML for .toml files."""
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return Scenario.from_dict(tomllib.load(f))
+    import yaml
+    with open(path, encoding="utf-8") as f:
+        return Scenario.from_dict(yaml.safe_load(f) or {})
+
+
+@dataclasses.dataclass(frozen=True)
+class Node:
+    """Step of a scenario; run returns False when its outputs were already up to date."""
+    name: str
+    run: Callable[[], bool]
+    needs: List[str] = dataclasses.field(default_factory=list)
+
+
+def check_dag(nodes: List[Node]) -> List[str]:
+    """Names of the nodes in an order running every node after what it needs, ValueError on unknown needs or cycles."""
+    names = {node.name for node in nodes}
+    waiting = {}
+    for node in nodes:
+        unknown = [need for need in node.needs if need not in names]
+        if unknown:
+            raise ValueError(f"{node.name} needs unknown nodes {unknown}")
+        waiting[node.name] = set(node.needs)
+    order = []
+    while waiting:
+        ready = [name for (name, needs) in waiting.items() if not needs]
+        if not ready:
+            raise ValueError(f"Nodes {sorted(waiting)} depend on each other")
+        for name in ready:
+            del waiting[name]
+            for needs in waiting.values():
+                needs.discard(name)
+        order += ready
+    return order
+
+
+def run_dag(nodes: List[Node], jobs: int) -> Dict[str, str]:
+    """Runs every node once all it needs has finished, up to jobs nodes at once.
+
+    A failing node skips the nodes depending on it while the others go on, failures are
+    raised together at the end. Returns the state of every node, one of NODE_STATES.
+    """
+    check_dag(nodes)
+    by_name = {node.name: node for node in nodes}
+    dependents = defaultdict(list)
+    for node in nodes:
+        for need in node.needs:
+            dependents[need].append(node.name)
+    waiting = {node.name: set(node.needs) for node in nodes}
+    states: Dict[str, str] = {}
+    errors = []
+
+    def skip(name):
+        for dependent in dependents[name]:
+            if dependent in waiting:
+                del waiting[dependent]
+                states[dependent] = "skipped"
+                print(f"Skipping {dependent}, {name} did not finish")
+                skip(dependent)
+
+    def run_node(node):
+        with instrumentation.span("scenario.node", node=node.name):
+            return node.run()
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        running = {}
+        while waiting or running:
+            for name in [name for (name, needs) in waiting.items() if not needs]:
+                del waiting[name]
+                running[pool.submit(run_node, by_name[name])] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    states[name] = "done" if future.result() else "up to date"
+                except Exception as e:
+                    print(f"{name} failed: {e!r}")
+                    states[name] = "failed"
+                    errors.append((name, e))
+                    skip(name)
+                    continue
+                for dependent in dependents[name]:
+                    if dependent in waiting:
+                        waiting[dependent].discard(name)
+
+    if errors:
+        failed = ", ".join(name for (name, _) in errors)
+        raise RuntimeError(f"{len(errors)} of {len(nodes)} scenario nodes failed: {failed}") from errors[0][1]
+    return states
+
+
+def _fingerprint(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _is_current(minio_client: minio.Minio, bucket_name: str, object_name: str, fingerprint: str) -> bool:
+    metadata = minio_communication.get_object_metadata(minio_client, bucket_name, object_name)
+    return metadata is not None and metadata.get("inputs-sha256") == fingerprint
+
+
+def ingest(minio_client: minio.Minio, election: ElectionSpec, force: bool = False) -> bool:
+    # Archives not modified since the last run and unchanged members are skipped by the ingest itself
+    return scrape.Ingest(minio_client, force=force).run({election.key: election.links})
+
+
+def normalize_election(minio_client: minio.Minio, election: ElectionSpec, force: bool = False) -> bool:
+    """Normalizes raw files of the election and partitions its results of the level it is built from."""
+    written = bool(normalize.normalize_year(minio_client, election.key, force))
+    if election.level != CONSTITUENCIES_LEVEL:
+        written |= areas.partition_year(minio_client, election.key, election.level, force)
+    return written
+
+
+def apportion(minio_client: minio.Minio, scenario: Scenario, election: ElectionSpec) -> bool:
+    pending = pending_methods(minio_client, [election.key], scenario.methods, scenario.force, scenario.output_format, level=election.level)
+    if not pending:
+        return False
+    with minio_communication.BatchWriter(minio_client) as writer:
+        if scenario.workers > 1:
+            run_parallel(minio_client, pending, scenario.workers, scenario.output_format, writer, election.level)
+        else:
+            fingerprint, methods = pending[election.key]
+            run_year(minio_client, election.key, methods, fingerprint, scenario.output_format, writer, election.level)
+    return True
+
+
+def threshold_sweep(minio_client: minio.Minio, scenario: Scenario, election: ElectionSpec) -> bool:
+    """Threshold sweep of the batch methods of the scenario, saved like thresholds.py does."""
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(election.key)
+    methods = scenario.threshold_methods()
+    object_name = f"threshold-sweep.{scenario.output_format}"
+    fingerprint = _fingerprint([inputs_fingerprint(minio_client, bucket_configuration, election.key, election.level), methods, scenario.threshold_rules])
+    if not scenario.force and _is_current(minio_client, bucket_configuration.transformed_data_bucket, object_name, fingerprint):
+        print(f"Threshold sweep for {election.key} is up to date, skipping")
+        return False
+    print(f"Sweeping {len(scenario.threshold_rules)} threshold rules of {len(methods)} methods for {election.key}")
+    table = sweep(load_election_data(minio_client, election.key, level=election.level), methods, scenario.threshold_rules)
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+    write_df_to_minio(minio_client, bucket_configuration.transformed_data_bucket, object_name, table, scenario.output_format,
+                      {"inputs-sha256": fingerprint})
+    return True
+
+
+def report(minio_client: minio.Minio, scenario: Scenario) -> bool:
+    """Seats of every committy by every method in every election as one tidy table."""
+    bucket_name = scenario.report_bucket
+    object_name = f"{scenario.report_object}.{scenario.output_format}"
+    fingerprints = {str(election.key): inputs_fingerprint(minio_client, minio_communication.get_minio_bucket_configuration(election.key),
+                                                          election.key, election.level)
+                    for election in scenario.elections}
+    fingerprint = _fingerprint([fingerprints, scenario.methods])
+    if not scenario.force and _is_current(minio_client, bucket_name, object_name, fingerprint):
+        print("Scenario report is up to date, skipping")
+        return False
+
+    tables = []
+    for election in scenario.elections:
+        bucket_configuration = minio_communication.get_minio_bucket_configuration(election.key)
+        for method in scenario.methods:
+            data = minio_communication.read_object_bytes(minio_client, bucket_configuration.transformed_data_bucket,
+                                                         seats_obj_name(select_method(method), scenario.output_format))
+            if data is None:
+                raise FileNotFoundError(f"No seats of {method} for {election.key}")
+            seats = normalize.read_parquet(data) if scenario.output_format == "parquet" else pd.read_csv(io.BytesIO(data))
+            tables.append(seats.assign(election=str(election.key), method=method)[['election', 'method', 'party', 'seats']])
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_name)
+    write_df_to_minio(minio_client, bucket_name, object_name, pd.concat(tables, ignore_index=True), scenario.output_format,
+                      {"inputs-sha256": fingerprint})
+    return True
+
+
+def build_nodes(minio_client: minio.Minio, scenario: Scenario, stages: List[str] = STAGES) -> List[Node]:
+    """Nodes of the scenario: ingest, normalize and apportion of every election, threshold sweeps
+    next to the apportion, and one report of all elections.
+
+    Stages left out are taken as done. Elections without sources are expected in storage already.
+    """
+    nodes = []
+    apportioned = []
+    for election in scenario.elections:
+        key = election.key
+        needs = []
+        if "ingest" in stages and election.links:
+            nodes.append(Node(f"ingest/{key}", lambda election=election: ingest(minio_client, election, scenario.force)))
+            needs = [f"ingest/{key}"]
+        if "normalize" in stages:
+            nodes.append(Node(f"normalize/{key}", lambda election=election: normalize_election(minio_client, election, scenario.force), needs))
+            needs = [f"normalize/{key}"]
+        if "apportion" in stages:
+            nodes.append(Node(f"apportion/{key}", lambda election=election: apportion(minio_client, scenario, election), needs))
+            apportioned.append(f"apportion/{key}")
+        # After the apportion, which builds the election data both use
+        if "thresholds" in stages and scenario.threshold_rules and scenario.threshold_methods():
+            nodes.append(Node(f"thresholds/{key}", lambda election=election: threshold_sweep(minio_client, scenario, election),
+                              [f"apportion/{key}"] if "apportion" in stages else needs))
+    if "report" in stages and scenario.report_bucket is not None:
+        nodes.append(Node("report", lambda: report(minio_client, scenario), apportioned))
+    return nodes
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenario', type=str,
+                        help='YAML (or .toml) file listing elections, methods, thresholds and outputs')
+    parser.add_argument('--stage', type=str, nargs='+', choices=STAGES, default=STAGES,
+                        help='stages to run, the others are taken as done')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='nodes run at the same time, overrides run.jobs of the scenario')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes of every apportion node, overrides run.workers of the scenario')
+    parser.add_argument('--force', action='store_true',
+                        help='run every node even if its outputs are up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the nodes in the order they may run')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    scenario = load_scenario(program_args.scenario)
+    overrides = {"jobs": program_args.jobs, "workers": program_args.workers, "force": program_args.force or None}
+    scenario = dataclasses.replace(scenario, **{key: value for (key, value) in overrides.items() if value is not None})
+    for election in scenario.elections:
+        election.register()
+
+    minio_client = minio_communication.get_client()
+    nodes = build_nodes(minio_client, scenario, program_args.stage)
+    if program_args.dry_run:
+        needs = {node.name: node.needs for node in nodes}
+        for name in check_dag(nodes):
+            print(f"{name} <- {', '.join(needs[name])}" if needs[name] else name)
+        return
+
+    with instrumentation.instrumented(program_args, "scenario"):
+        states = run_dag(nodes, scenario.jobs)
+    for (name, state) in states.items():
+        print(f"{name}: {state}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,540 @@
 #!/usr/bin/env python
+import argparse
+import hashlib
+import io
 import minio
 import os
-import shutil
-import tempfile
+import random
+import struct
+import threading
+import time
+import urllib.error
 import urllib.request
-import zipfile
+import urllib3
+import zlib
 
-from typing import List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from minio.error import S3Error, ServerError
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
 
+import areas
+import instrumentation
 import minio_communication
+import normalize
 
 from consts import LINKS_BY_YEAR
 
 
-def temporary_direrctory() -> str:
-    """Create temporary directory and return path to it."""
-    return tempfile.mkdtemp()
+# Bytes read from the network at once, bounds memory used by the ingest
+CHUNK_SIZE = 1024 * 1024
+# Part size of multipart uploads of members with unknown size
+UPLOAD_PART_SIZE = 10 * 1024 * 1024
+# Members up to this size are buffered and uploaded concurrently with the rest of the archive
+BUFFERED_UPLOAD_LIMIT = 8 * 1024 * 1024
 
+LOCAL_FILE_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+STORED = 0
+DEFLATED = 8
 
-def remove_directory(path: str) -> None:
-    """Removes directory."""
-    shutil.rmtree(path)
 
+class PushbackStream:
+    """Readable stream which can take back bytes read too far."""
 
-def download_file(url: str, path: str) -> None:
-    """Download file from url and save it to path."""
-    filename = url.split("/")[-1]
-    print(f"Downloading {filename} to {path}")
-    urllib.request.urlretrieve(url, path + "/" + filename)
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+        self.buffer = b""
 
+    def read(self, size: int) -> bytes:
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
 
-def unzip_all_files(path: str) -> None:
-    """Unzip all files in directory."""
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(".zip"):
-                file_path = os.path.join(root, file)
-                with zipfile.ZipFile(file_path, "r") as zip_ref:
-                    zip_ref.extractall(root)
+    def read_exactly(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise EOFError("Unexpected end of zip stream")
+            data += chunk
+        return data
 
+    def unread(self, data: bytes) -> None:
+        self.buffer = data + self.buffer
 
-def load_csv_files(path: str) -> List[Tuple[str, str]]:
-    """Load all csv files in directory and return list of tuples with file name and content."""
-    csv_files = []
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(".csv"):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r") as f:
-                    csv_files.append((file_path, f.read()))
-    return csv_files
 
+class ZipMemberReader:
+    """Decompresses one zip member straight from the archive stream, as a readable stream."""
 
-def upload_csv_files(minio_client: minio.Minio, year: int, csv_files: List[Tuple[str, str]]) -> None:
-    bucket_name = minio_communication.get_minio_bucket_configuration(year).raw_data_bucket
-    minio_communication.create_bucket_if_not_exist(minio_client, bucket_name)
-    obj_names = set()
-    for (csv_file_path, _) in csv_files:
-        obj_name = os.path.basename(csv_file_path)
-        if obj_name in obj_names:
+    def __init__(self, stream: PushbackStream, method: int, compressed_size: Optional[int], crc: Optional[int]) -> None:
+        if method not in (STORED, DEFLATED):
+            raise ValueError(f"Unsupported zip compression method {method}")
+        if method == STORED and compressed_size is None:
+            raise ValueError("Stored zip member of unknown size cannot be streamed")
+        self.stream = stream
+        self.method = method
+        self.remaining = compressed_size
+        self.crc = crc
+        self.computed_crc = 0
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == DEFLATED else None
+        self.pending = b""
+        self.finished = False
+
+    def _next_compressed(self) -> bytes:
+        size = CHUNK_SIZE if self.remaining is None else min(CHUNK_SIZE, self.remaining)
+        if size == 0:
+            return b""
+        data = self.stream.read(size)
+        if not data:
+            raise EOFError("Unexpected end of zip stream")
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def _fill(self) -> None:
+        if self.method == STORED:
+            data = self._next_compressed()
+            self.finished = self.remaining == 0
+        else:
+            compressed = self.decompressor.unconsumed_tail or self._next_compressed()
+            if not compressed:
+                raise EOFError("Zip member ended before its deflate stream")
+            data = self.decompressor.decompress(compressed, CHUNK_SIZE)
+            if self.decompressor.eof:
+                # Deflate stream ends by itself, bytes after it belong to the archive
+                self.stream.unread(self.decompressor.unused_data)
+                self.finished = True
+        self.computed_crc = zlib.crc32(data, self.computed_crc)
+        self.pending += data
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.finished and (size < 0 or len(self.pending) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        if self.finished and not self.pending and self.crc is not None and self.crc != self.computed_crc:
+            raise ValueError("Zip member checksum mismatch")
+        return data
+
+    def drain(self) -> None:
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def iter_zip_members(stream: BinaryIO) -> Iterator[Tuple[str, Optional[int], ZipMemberReader]]:
+    """Iterates over members of a zip archive read sequentially from a stream.
+
+    Yields name, uncompressed size (None if only known after the data) and a reader
+    of every member. Each reader has to be used before moving to the next member,
+    the rest of it is skipped. Memory use does not depend on the archive size.
+    """
+    stream = PushbackStream(stream)
+    while True:
+        signature = stream.read(4)
+        if len(signature) < 4 or struct.unpack("<I", signature)[0] != LOCAL_FILE_HEADER:
+            # Central directory follows the last member
+            return
+
+        (_, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = struct.unpack("<HHHHHIIIHH", stream.read_exactly(26))
+        name = stream.read_exactly(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = stream.read_exactly(extra_length)
+
+        zip64 = compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF
+        if zip64:
+            (size, compressed_size) = _zip64_sizes(extra)
+
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor:
+            crc, compressed_size, size = None, None, None
+
+        reader = ZipMemberReader(stream, method, compressed_size, crc)
+        yield (name, size, reader)
+        reader.drain()
+
+        if has_descriptor:
+            descriptor = stream.read_exactly(4)
+            if struct.unpack("<I", descriptor)[0] == DATA_DESCRIPTOR:
+                descriptor = stream.read_exactly(4)
+            (reader.crc,) = struct.unpack("<I", descriptor)
+            stream.read_exactly(16 if zip64 else 8)
+            if reader.crc != reader.computed_crc:
+                raise ValueError(f"Zip member {name} checksum mismatch")
+
+
+def _zip64_sizes(extra: bytes) -> Tuple[int, int]:
+    offset = 0
+    while offset + 4 <= len(extra):
+        (tag, length) = struct.unpack("<HH", extra[offset:offset + 4])
+        if tag == 0x0001:
+            return struct.unpack("<QQ", extra[offset + 4:offset + 20])
+        offset += 4 + length
+    raise ValueError("Zip64 member without zip64 extra field")
+
+
+def upload_member(minio_client: minio.Minio, bucket_name: str, obj_name: str, size: Optional[int], reader: BinaryIO,
+                  metadata: Optional[Dict[str, str]] = None) -> None:
+    """Streams one member to minio, as a multipart upload when its size is unknown."""
+    with instrumentation.span("minio.put_object", bucket=bucket_name, object=obj_name, streamed=True) as span:
+        if size is None:
+            minio_client.put_object(bucket_name, obj_name, reader, -1, part_size=UPLOAD_PART_SIZE, metadata=metadata)
+        else:
+            minio_client.put_object(bucket_name, obj_name, reader, size, metadata=metadata)
+        if isinstance(reader, CountingReader):
+            span.add(bytes=reader.size)
+
+
+class ObjectNameRegistry:
+    """Object names already taken in each bucket, shared by concurrent ingests.
+
+    A name claimed again by the same source (a retried archive) is fine,
+    the same basename coming from two sources is an error.
+    """
+
+    def __init__(self) -> None:
+        self.owners: Dict[Tuple[str, str], str] = {}
+        self.lock = threading.Lock()
+
+    def claim(self, bucket_name: str, path: str, source: str) -> str:
+        obj_name = os.path.basename(path)
+        with self.lock:
+            owner = self.owners.setdefault((bucket_name, obj_name), source)
+        if owner != source:
             raise ValueError(f"Multiple files with same basename {obj_name}")
-        obj_names.add(obj_name)
-        minio_communication.upload_file(minio_client, bucket_name, obj_name, csv_file_path)
+        return obj_name
 
 
-def main() -> None:
-    directory = temporary_direrctory()
-    minio_client = minio_communication.get_client()
+def is_transient(error: Exception) -> bool:
+    """Tells whether the failed operation is worth repeating."""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, S3Error):
+        return error.code in ("InternalError", "SlowDown", "ServiceUnavailable", "RequestTimeout")
+    return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError, EOFError, ServerError, urllib3.exceptions.HTTPError))
+
+
+def with_retries(operation: Callable[[], None], retries: int, backoff: float, description: str) -> None:
+    """Runs operation, repeating it after transient failures with exponential backoff and jitter."""
+    for attempt in range(retries + 1):
+        try:
+            return operation()
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            print(f"{description} failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class CountingReader:
+    """Passes reads through, counting bytes read."""
+
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+
+def member_metadata(sha256: Optional[str], crc: Optional[int], size: Optional[int]) -> Dict[str, str]:
+    """Content fingerprint stored as user metadata of every raw object.
+
+    Streamed members are uploaded with what is known before their data: the zip CRC and size
+    from the local header, none for members with a data descriptor (readers fall back to the ETag).
+    """
+    metadata = {} if sha256 is None else {"content-sha256": sha256}
+    if crc is not None and size is not None:
+        metadata.update({"content-crc32": f"{crc:08x}", "content-size": str(size)})
+    return metadata
+
+
+def source_state_obj_name(url: str) -> str:
+    """Object holding HTTP validators and members of one source archive."""
+    return f"_sources/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+
 
-    for year in LINKS_BY_YEAR:
-        year_dirname = os.path.join(directory, str(year))
-        os.makedirs(year_dirname)
+class Ingest:
+    """Downloads archives and uploads their csv files with bounded concurrency.
 
-        for link in LINKS_BY_YEAR[year]:
-            download_file(link, year_dirname)
+    Archives are decoded in parallel; within one archive members come in order,
+    so small members are buffered and uploaded by a separate pool while the archive
+    stream moves on, and big ones are streamed to minio directly.
 
-        unzip_all_files(year_dirname)
-        csv_files = load_csv_files(year_dirname)
+    Ingest is incremental: archives are requested with the ETag and Last-Modified
+    of the previous run and skipped on 304 Not Modified, and members whose content
+    hash (or zip CRC for streamed ones) matches the metadata of the stored object
+    are not uploaded again. With force everything is downloaded and uploaded.
+    Members streamed with a data descriptor have no CRC before their data and are uploaded
+    whenever their archive changed.
+    """
 
-        upload_csv_files(minio_client, year, csv_files)
+    def __init__(self, minio_client: minio.Minio, concurrency: int = 4, retries: int = 3, backoff: float = 1.0, force: bool = False) -> None:
+        self.minio_client = minio_client
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.force = force
+        self.registry = ObjectNameRegistry()
+        self.upload_pool = ThreadPoolExecutor(max_workers=concurrency)
+        # At most concurrency buffered members wait for upload, bounding memory
+        self.upload_slots = threading.BoundedSemaphore(concurrency)
 
-    remove_directory(directory)
+    def _upload_buffered(self, bucket_name: str, obj_name: str, data: bytes, metadata: Dict[str, str]) -> None:
+        try:
+            with_retries(lambda: minio_communication.put_bytes(self.minio_client, bucket_name, obj_name, data, metadata=metadata),
+                         self.retries, self.backoff, f"Upload of {obj_name}")
+        finally:
+            self.upload_slots.release()
+
+    def _stored_metadata(self, bucket_name: str, obj_name: str) -> Dict[str, str]:
+        if self.force:
+            return {}
+        return minio_communication.get_object_metadata(self.minio_client, bucket_name, obj_name) or {}
+
+    def _request(self, bucket_name: str, url: str) -> urllib.request.Request:
+        """Request for the archive, conditional if everything from the previous run is still stored."""
+        request = urllib.request.Request(url)
+        if self.force:
+            return request
+        state = minio_communication.read_json_object(self.minio_client, bucket_name, source_state_obj_name(url))
+        if state is None or any(minio_communication.get_object_metadata(self.minio_client, bucket_name, name) is None for name in state["members"]):
+            return request
+        if state.get("etag"):
+            request.add_header("If-None-Match", state["etag"])
+        if state.get("last-modified"):
+            request.add_header("If-Modified-Since", state["last-modified"])
+        return request
+
+    def ingest_archive(self, bucket_name: str, url: str, uploads: List[Future]) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Streams one archive.
+
+        Pending uploads of its buffered members are appended to uploads, also when the archive fails.
+        Returns the state to save once they finish (None if the archive did not change)
+        and the number of members uploaded.
+        """
+        filename = url.split("/")[-1]
+        with instrumentation.span("scrape.archive", url=url) as span:
+            try:
+                response = urllib.request.urlopen(self._request(bucket_name, url))
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    print(f"{filename} not modified, skipping")
+                    span.add(not_modified=True)
+                    return (None, 0)
+                raise
+
+            print(f"Streaming {filename} to {bucket_name}")
+            uploaded = 0
+            state = {"url": url, "etag": response.headers.get("ETag"), "last-modified": response.headers.get("Last-Modified"), "members": []}
+            span.add(bytes=int(response.headers.get("Content-Length") or 0))
+            with response:
+                for (name, size, reader) in iter_zip_members(response):
+                    if not name.endswith(".csv"):
+                        continue
+                    obj_name = self.registry.claim(bucket_name, name, url)
+                    state["members"].append(obj_name)
+                    stored = self._stored_metadata(bucket_name, obj_name)
+
+                    if size is not None and size <= BUFFERED_UPLOAD_LIMIT:
+                        self.upload_slots.acquire()
+                        try:
+                            data = reader.read()
+                        except BaseException:
+                            self.upload_slots.release()
+                            raise
+                        sha256 = hashlib.sha256(data).hexdigest()
+                        if stored.get("content-sha256") == sha256:
+                            self.upload_slots.release()
+                            print(f"{obj_name} unchanged")
+                            continue
+                        metadata = member_metadata(sha256, reader.crc, size)
+                        span.add(uploaded=1)
+                        uploaded += 1
+                        uploads.append(self.upload_pool.submit(self._upload_buffered, bucket_name, obj_name, data, metadata))
+                        continue
+
+                    # Content of streamed members is only known after upload, the zip CRC identifies it before
+                    if reader.crc is not None and stored.get("content-crc32") == f"{reader.crc:08x}" and stored.get("content-size") == str(size):
+                        print(f"{obj_name} unchanged")
+                        continue
+                    span.add(uploaded=1)
+                    uploaded += 1
+                    upload_member(self.minio_client, bucket_name, obj_name, size, CountingReader(reader),
+                                  member_metadata(None, reader.crc, size))
+            span.add(members=len(state["members"]))
+            return (state, uploaded)
+
+    def _ingest_with_retries(self, bucket_name: str, url: str) -> Tuple[List[Future], Optional[Dict[str, Any]], int]:
+        result = []
+        def attempt():
+            uploads = []
+            try:
+                (state, uploaded) = self.ingest_archive(bucket_name, url, uploads)
+            except BaseException:
+                # Uploads of a failed attempt finish, releasing their slots, before it is retried
+                for (upload, error) in [(upload, upload.exception()) for upload in uploads]:
+                    if error is not None:
+                        print(f"Upload from failed ingest of {url} failed too ({error!r})")
+                raise
+            result[:] = [(uploads, state, uploaded)]
+        with_retries(attempt, self.retries, self.backoff, f"Ingest of {url}")
+        return result[0]
+
+    def run(self, links_by_year: Dict[int, List[str]]) -> bool:
+        """Ingests archives of every year, returns whether any member was uploaded."""
+        changed = False
+        for year in links_by_year:
+            bucket_name = minio_communication.get_minio_bucket_configuration(year).raw_data_bucket
+            minio_communication.create_bucket_if_not_exist(self.minio_client, bucket_name)
+
+        with self.upload_pool, ThreadPoolExecutor(max_workers=self.concurrency) as archive_pool:
+            archives = {
+                archive_pool.submit(self._ingest_with_retries, bucket_name, link): (bucket_name, link)
+                for year in links_by_year
+                for bucket_name in [minio_communication.get_minio_bucket_configuration(year).raw_data_bucket]
+                for link in links_by_year[year]
+            }
+            for archive in as_completed(archives):
+                uploads, state, uploaded = archive.result()
+                changed |= uploaded > 0
+                for upload in uploads:
+                    upload.result()
+                # Saved last, so an interrupted ingest is not taken as up to date
+                if state is not None:
+                    bucket_name, link = archives[archive]
+                    minio_communication.write_json_object(self.minio_client, bucket_name, source_state_obj_name(link), state)
+        return changed
+
+
+class _UnseekableWriter:
+    """Write-only stream, makes zipfile write data descriptors like streaming archivers do."""
+
+    def __init__(self) -> None:
+        self.buffer = io.BytesIO()
+
+    def write(self, data: bytes) -> int:
+        return self.buffer.write(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def _zip_archive(members: List[Tuple[str, bytes, int]], seekable: bool = True, zip64: bool = False) -> bytes:
+    """Archive of (name, content, compression) members."""
+    import zipfile
+
+    stream = io.BytesIO() if seekable else _UnseekableWriter()
+    with zipfile.ZipFile(stream, "w") as archive:
+        for (name, content, compression) in members:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compression
+            with archive.open(info, "w", force_zip64=zip64) as member:
+                member.write(content)
+    return (stream if seekable else stream.buffer).getvalue()
+
+
+def test(seed = 0):
+    """Ingests generated archives served over local HTTP into the in-memory storage.
+
+    Covers stored and deflated members, data descriptors, zip64 headers and members
+    big enough to be streamed; a second run has to be answered with 304 Not Modified.
+    """
+    import functools
+    import http.server
+    import tempfile
+    import zipfile
+
+    import storage
+
+    rng = random.Random(seed)
+    def csv(size):
+        rows = "".join(f"{i};{rng.randint(0, 10 ** 6)};{rng.choice(['KO', 'PIS', 'TD', 'NL'])}\n" for i in range(1_000)).encode("utf-8")
+        return (rows * (size // len(rows) + 1))[:size]
+    big = BUFFERED_UPLOAD_LIMIT + 1
+    archives = {
+        "plain.zip": _zip_archive([("dir/a.csv", csv(5_000), DEFLATED), ("b.csv", csv(3_000), STORED),
+                                   ("big.csv", csv(big), DEFLATED), ("notes.txt", b"skipped", DEFLATED)]),
+        "descriptor.zip": _zip_archive([("c.csv", csv(7_000), DEFLATED), ("streamed.csv", csv(big), DEFLATED)], seekable=False),
+        "zip64.zip": _zip_archive([("d.csv", csv(2_000), DEFLATED), ("e.csv", csv(1_000), STORED)], zip64=True),
+        "zip64-descriptor.zip": _zip_archive([("f.csv", csv(4_000), DEFLATED)], seekable=False, zip64=True),
+    }
+    members = [
+        (os.path.basename(info.filename), archive.read(info), bool(info.flag_bits & 0x8))
+        for data in archives.values()
+        for archive in [zipfile.ZipFile(io.BytesIO(data))]
+        for info in archive.infolist() if info.filename.endswith(".csv")
+    ]
+    expected = {obj_name: content for (obj_name, content, _) in members}
+
+    statuses = []
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def send_response(self, code, message=None):
+            statuses.append(code)
+            super().send_response(code, message)
+
+        def log_message(self, *args):
+            pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        for (name, data) in archives.items():
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            links = {2023: [f"http://127.0.0.1:{server.server_port}/{name}" for name in archives]}
+            client = storage.InMemoryStorage()
+            bucket_name = minio_communication.get_minio_bucket_configuration(2023).raw_data_bucket
+
+            assert Ingest(client, concurrency=2).run(links)
+            assert statuses == [200] * len(archives), statuses
+            stored = {obj_name: content for ((bucket, obj_name), (content, _)) in client.objects.items()
+                      if bucket == bucket_name and not obj_name.startswith("_sources/")}
+            assert stored.keys() == expected.keys(), sorted(stored)
+            for (obj_name, content, has_descriptor) in members:
+                assert stored[obj_name] == content, obj_name
+                metadata = minio_communication.get_object_metadata(client, bucket_name, obj_name)
+                # Buffered members carry their sha256, streamed ones the CRC from their local header
+                if not has_descriptor and len(content) <= BUFFERED_UPLOAD_LIMIT:
+                    assert metadata["content-sha256"] == hashlib.sha256(content).hexdigest(), (obj_name, metadata)
+                elif not has_descriptor:
+                    assert metadata["content-crc32"] == f"{zlib.crc32(content):08x}", (obj_name, metadata)
+                    assert metadata["content-size"] == str(len(content)), (obj_name, metadata)
+
+            statuses.clear()
+            assert not Ingest(client, concurrency=2).run(links)
+            assert statuses == [304] * len(archives), statuses
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    print(f"{len(expected)} members of {len(archives)} archives ingested, unchanged archives skipped")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='archives downloaded and members uploaded at the same time')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='retries of transient download and upload failures')
+    parser.add_argument('--force', action='store_true',
+                        help='download and upload everything, even if unchanged since the last run')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    minio_client = minio_communication.get_client()
+    with instrumentation.instrumented(program_args, "scrape"):
+        with instrumentation.span("scrape.ingest"):
+            Ingest(minio_client, program_args.concurrency, program_args.retries, force=program_args.force).run(LINKS_BY_YEAR)
+        normalize.normalize_years(minio_client, list(LINKS_BY_YEAR), program_args.force)
+        areas.partition_years(minio_client, list(LINKS_BY_YEAR), force=program_args.force)
 
 
 if __name__ == "__main__":
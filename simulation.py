@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import minio_communication
+from consts import *
+from election_data import ElectionData
+from transform import (
+    ALL_METHODS, ConstituencialDHondt, expand_methods, load_election_data,
+    select_method, supports_seats_batch, write_dict_json_to_minio,
+)
+
+
+NOISES = ["multinomial", "dirichlet", "swing"]
+
+
+def perturb(rng: np.random.Generator, votes: np.ndarray, draws: int, noise: str, concentration: float, swing: float) -> np.ndarray:
+    """Draws perturbed constituencies x committies vote matrices.
+
+    multinomial - every valid vote is cast again with the observed shares of its constituency,
+    dirichlet - shares of every constituency drawn around the observed ones, less spread for higher concentration,
+    swing - national uniform swing of up to +-swing percentage points for every committy.
+
+    Committies without votes in a constituency (no list there) get no votes in any draw.
+
+    Returns draws x constituencies x committies matrix of votes.
+    """
+    totals = votes.sum(axis=1)
+    shares = votes / totals[:, None]
+
+    if noise == "multinomial":
+        return rng.multinomial(totals.astype(np.int64), shares, size=(draws, len(totals))).astype(float)
+
+    if noise == "dirichlet":
+        drawn = rng.gamma(concentration * np.broadcast_to(shares, (draws,) + shares.shape))
+        drawn /= drawn.sum(axis=2, keepdims=True)
+    elif noise == "swing":
+        delta = rng.uniform(-swing, swing, size=(draws, 1, shares.shape[1])) / 100
+        # Committies without a list in a constituency do not swing into it
+        drawn = np.where(shares > 0, np.clip(shares + delta, 0, None), 0)
+        # A swing wiping out every list of a constituency leaves its observed shares
+        drawn = np.where(drawn.sum(axis=2, keepdims=True) > 0, drawn, shares)
+        drawn /= drawn.sum(axis=2, keepdims=True)
+    else:
+        raise NotImplementedError(noise)
+
+    return np.rint(drawn * totals[:, None])
+
+
+def apply_thresholds(votes: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """Zeroes votes of committies below their threshold in each scenario."""
+    totals = votes.sum(axis=1)
+    support = 100 * totals / totals.sum(axis=1, keepdims=True)
+    return votes * (support >= thresholds)[:, None, :]
+
+
+@dataclasses.dataclass
+class SimulationSummary:
+    """Statistics of one method, accumulated batch by batch without keeping the draws."""
+    method: str
+    comitties: List[str]
+    units: List[str]
+    baseline: np.ndarray
+    draws: int = dataclasses.field(init=False, default=0)
+    seat_histogram: np.ndarray = dataclasses.field(init=False)
+    majority_draws: np.ndarray = dataclasses.field(init=False)
+    seats_sum: np.ndarray = dataclasses.field(init=False)
+    seats_squared_sum: np.ndarray = dataclasses.field(init=False)
+    unit_flips: np.ndarray = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        total_seats = int(self.baseline.sum())
+        comitties = len(self.comitties)
+        self.seat_histogram = np.zeros((comitties, total_seats + 1), dtype=np.int64)
+        self.majority_draws = np.zeros(comitties, dtype=np.int64)
+        self.seats_sum = np.zeros(comitties, dtype=np.int64)
+        self.seats_squared_sum = np.zeros(comitties, dtype=np.int64)
+        self.unit_flips = np.zeros(self.baseline.shape, dtype=np.int64)
+
+    def add(self, unit_seats: np.ndarray) -> None:
+        """Adds scenarios x units x committies seats of one batch."""
+        seats = unit_seats.sum(axis=1)
+        total_seats = self.seat_histogram.shape[1] - 1
+        comitties = np.broadcast_to(np.arange(seats.shape[1]), seats.shape)
+        np.add.at(self.seat_histogram, (comitties, seats), 1)
+        self.majority_draws += (2 * seats > total_seats).sum(axis=0)
+        self.seats_sum += seats.sum(axis=0)
+        self.seats_squared_sum += (seats * seats).sum(axis=0)
+        self.unit_flips += (unit_seats != self.baseline).sum(axis=0)
+        self.draws += seats.shape[0]
+
+    def mean_seats(self) -> np.ndarray:
+        return self.seats_sum / self.draws
+
+    def std_seats(self) -> np.ndarray:
+        mean = self.mean_seats()
+        return np.sqrt(np.maximum(self.seats_squared_sum / self.draws - mean * mean, 0))
+
+    def majority_probability(self) -> np.ndarray:
+        return self.majority_draws / self.draws
+
+    def flip_probability(self) -> np.ndarray:
+        """Probability that seats of a committy in a unit differ from the unperturbed result."""
+        return self.unit_flips / self.draws
+
+    def to_dict(self) -> Dict[str, Any]:
+        mean, std = self.mean_seats(), self.std_seats()
+        majority, flips = self.majority_probability(), self.flip_probability()
+        baseline = self.baseline.sum(axis=0)
+        return {
+            "method": self.method,
+            "draws": self.draws,
+            "comitties": {
+                name: {
+                    "baseline seats": int(baseline[i]),
+                    "mean seats": float(mean[i]),
+                    "std seats": float(std[i]),
+                    "majority probability": float(majority[i]),
+                    "seat distribution": {seats: int(count) for (seats, count) in enumerate(self.seat_histogram[i]) if count},
+                }
+                for (i, name) in enumerate(self.comitties)
+            },
+            "flip probability": {
+                unit: {name: float(flips[u, i]) for (i, name) in enumerate(self.comitties) if flips[u, i]}
+                for (u, unit) in enumerate(self.units)
+            },
+        }
+
+
+def simulate(ed: ElectionData, methods: List[str], draws: int = 10_000, batch_size: int = 1_000,
+             noise: str = "multinomial", seed: Optional[int] = None,
+             concentration: float = 1_000, swing: float = 2.0) -> Dict[str, SimulationSummary]:
+    """Reruns given methods on randomly perturbed votes.
+
+    All methods see the same draws, generated and allocated in vectorized batches of batch_size.
+    Every committy is perturbed, also those failing the threshold, as it may be passed after perturbation.
+    """
+    rng = np.random.default_rng(seed)
+    comitties = ed.committy_names
+    votes = ed.votes.astype(float)
+    seats = np.array(ed.seats, dtype=int)
+    cnames = [f"C-{id} ({cname})" for (id, cname) in zip(ed.district_ids, ed.district_names)]
+
+    apportionments = {method: select_method(method) for method in methods}
+    thresholds = {method: np.array([a.threshold(c) for c in ed.committies]) for (method, a) in apportionments.items()}
+
+    summaries = {}
+    for (method, apportionment) in apportionments.items():
+        baseline = apportionment.seats_batch(apply_thresholds(votes[None], thresholds[method]), seats)[0]
+        units = cnames if baseline.shape[0] == len(cnames) else ["national"]
+        summaries[method] = SimulationSummary(method, comitties, units, baseline)
+
+    done = 0
+    while done < draws:
+        batch = perturb(rng, votes, min(batch_size, draws - done), noise, concentration, swing)
+        for (method, apportionment) in apportionments.items():
+            summaries[method].add(apportionment.seats_batch(apply_thresholds(batch, thresholds[method]), seats))
+        done += batch.shape[0]
+
+    return summaries
+
+
+def simulation_obj_name(apportionment) -> str:
+    return f"{apportionment.name()}-simulation.json"
+
+
+def test(draws = 200, seed = 0):
+    """Checks that every noise keeps the votes of constituencies and gives none to committies without a list there."""
+    rng = np.random.default_rng(seed)
+    votes = rng.integers(1_000, 100_000, size=(20, 8)).astype(float)
+    votes[rng.random(votes.shape) < 0.3] = 0
+    votes[:, 0] = np.maximum(votes[:, 0], 1)
+    for noise in NOISES:
+        drawn = perturb(rng, votes, draws, noise, concentration=100, swing=20)
+        assert drawn.shape == (draws,) + votes.shape, (noise, drawn.shape)
+        assert (drawn[:, votes == 0] == 0).all(), noise
+        assert (np.abs(drawn.sum(axis=2) - votes.sum(axis=1)) <= votes.shape[1]).all(), noise
+
+    # Swing bigger than the shares of every list in the constituency
+    votes = np.array([[5_000, 3_000, 2_000, 0]], dtype=float)
+    drawn = perturb(rng, votes, 10 * draws, "swing", concentration=100, swing=60)
+    assert np.isfinite(drawn).all() and (drawn[..., 3] == 0).all() and (np.abs(drawn.sum(axis=2) - 10_000) <= 4).all()
+    print(f"{draws} draws of every noise keep missing lists without votes")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, choices=YEARS, default=2023,
+                        help='year to analyze')
+    parser.add_argument('--apportionment', type=str, nargs='+', default=[ConstituencialDHondt.name()],
+                        help=f'apportionments to simulate, "{ALL_METHODS}" runs every method supporting simulation')
+    parser.add_argument('--draws', type=int, default=10_000,
+                        help='number of perturbed scenarios')
+    parser.add_argument('--batch-size', type=int, default=1_000,
+                        help='scenarios generated and allocated at once')
+    parser.add_argument('--noise', type=str, choices=NOISES, default="multinomial",
+                        help='kind of vote perturbation')
+    parser.add_argument('--concentration', type=float, default=1_000,
+                        help='dirichlet concentration, higher is closer to observed shares')
+    parser.add_argument('--swing', type=float, default=2.0,
+                        help='maximal uniform swing in percentage points')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    methods = expand_methods(program_args.apportionment)
+    if ALL_METHODS in program_args.apportionment:
+        methods = [method for method in methods if supports_seats_batch(method)]
+    for method in methods:
+        if not supports_seats_batch(method):
+            raise NotImplementedError(f"{method} does not support simulation")
+
+    minio_client = minio_communication.get_client()
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(program_args.year)
+    ed = load_election_data(minio_client, program_args.year)
+
+    summaries = simulate(ed, methods, program_args.draws, program_args.batch_size, program_args.noise,
+                         program_args.seed, program_args.concentration, program_args.swing)
+
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+    for (method, summary) in summaries.items():
+        print(f"Saving simulation of {program_args.year} {method}")
+        write_dict_json_to_minio(minio_client, bucket_configuration.transformed_data_bucket,
+                                 simulation_obj_name(select_method(method)), summary.to_dict())
+
+
+if __name__ == "__main__":
+    main()
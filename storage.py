@@ -0,0 +1,319 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+import minio
+from minio.commonconfig import REPLACE, CopySource
+from minio.datatypes import Object
+from minio.error import S3Error
+
+from consts import *
+
+
+# Bytes read at once from streams of unknown length
+CHUNK_SIZE = 1024 * 1024
+METADATA_DIR = ".metadata"
+
+
+def _error(code: str, message: str, bucket_name: str, object_name: Optional[str] = None) -> S3Error:
+    return S3Error(None, code, message, object_name or bucket_name, "", "", bucket_name, object_name)
+
+
+def _user_metadata(metadata: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """User metadata with the x-amz-meta- prefix, as MinIO returns it from stat_object."""
+    return {f"x-amz-meta-{key.lower()}": str(value) for (key, value) in (metadata or {}).items()}
+
+
+def _read_all(data: BinaryIO, length: int) -> bytes:
+    if length >= 0:
+        return data.read(length)
+    chunks = []
+    while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+class Storage(ABC):
+    """Object storage with the part of the minio.Minio API this project uses.
+
+    Buckets hold objects with user metadata; missing buckets and objects raise S3Error
+    with the same codes as MinIO, so code written against minio.Minio works with every backend.
+    """
+
+    @abstractmethod
+    def bucket_exists(self, bucket_name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def make_bucket(self, bucket_name: str) -> None:
+        pass
+
+    @abstractmethod
+    def put_object(self, bucket_name: str, object_name: str, data: BinaryIO, length: int,
+                   content_type: str = "application/octet-stream", metadata: Optional[Dict[str, str]] = None, part_size: int = 0, **kwargs) -> None:
+        pass
+
+    @abstractmethod
+    def get_object(self, bucket_name: str, object_name: str, **kwargs) -> BinaryIO:
+        """Readable response, closed with close() and release_conn() like a MinIO one."""
+        pass
+
+    @abstractmethod
+    def stat_object(self, bucket_name: str, object_name: str, **kwargs) -> Object:
+        pass
+
+    @abstractmethod
+    def list_objects(self, bucket_name: str, prefix: Optional[str] = None, recursive: bool = False, **kwargs) -> Iterator[Object]:
+        pass
+
+    def copy_object(self, bucket_name: str, object_name: str, source: CopySource, metadata: Optional[Dict[str, str]] = None,
+                    metadata_directive: Optional[str] = None, **kwargs) -> None:
+        stat = self.stat_object(source.bucket_name, source.object_name)
+        if metadata_directive != REPLACE:
+            metadata = {key[len("x-amz-meta-"):]: value for (key, value) in stat.metadata.items() if key.startswith("x-amz-meta-")}
+        response = self.get_object(source.bucket_name, source.object_name)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        self.put_object(bucket_name, object_name, io.BytesIO(data), len(data), stat.content_type or "application/octet-stream", metadata)
+
+
+Storage.register(minio.Minio)
+
+
+def _list(bucket_name: str, names: Iterator[Tuple[str, Tuple[int, str]]], prefix: Optional[str], recursive: bool) -> Iterator[Object]:
+    """Objects of sorted (name, (size, etag)) pairs under prefix, grouped into directories at "/" unless recursive."""
+    prefix = prefix or ""
+    directories = set()
+    for (name, (size, etag)) in names:
+        if not name.startswith(prefix):
+            continue
+        rest = name[len(prefix):]
+        if not recursive and "/" in rest:
+            directory = prefix + rest.split("/")[0] + "/"
+            if directory not in directories:
+                directories.add(directory)
+                yield Object(bucket_name, directory)
+            continue
+        yield Object(bucket_name, name, etag=etag, size=size)
+
+
+class InMemoryResponse(io.BytesIO):
+    def release_conn(self) -> None:
+        pass
+
+
+class InMemoryStorage(Storage):
+    """Objects kept in a dict of the process, for tests, benchmarks and sweeps without a server."""
+
+    def __init__(self) -> None:
+        self.objects: Dict[Tuple[str, str], Tuple[bytes, Dict[str, str]]] = {}
+        self.buckets = set()
+        self.lock = threading.Lock()
+
+    def _entry(self, bucket_name: str, object_name: str) -> Tuple[bytes, Dict[str, str]]:
+        entry = self.objects.get((bucket_name, object_name))
+        if entry is None:
+            if bucket_name not in self.buckets:
+                raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+            raise _error("NoSuchKey", "Object does not exist", bucket_name, object_name)
+        return entry
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name: str) -> None:
+        with self.lock:
+            if bucket_name in self.buckets:
+                raise _error("BucketAlreadyOwnedByYou", "Bucket already exists", bucket_name)
+            self.buckets.add(bucket_name)
+
+    def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream", metadata=None, part_size=0, **kwargs) -> None:
+        content = _read_all(data, length)
+        with self.lock:
+            if bucket_name not in self.buckets:
+                raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+            self.objects[(bucket_name, object_name)] = (content, {**_user_metadata(metadata), "content-type": content_type})
+
+    def get_object(self, bucket_name, object_name, **kwargs) -> InMemoryResponse:
+        return InMemoryResponse(self._entry(bucket_name, object_name)[0])
+
+    def stat_object(self, bucket_name, object_name, **kwargs) -> Object:
+        content, metadata = self._entry(bucket_name, object_name)
+        return Object(bucket_name, object_name, etag=hashlib.md5(content).hexdigest(), size=len(content),
+                      metadata=dict(metadata), content_type=metadata["content-type"])
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, **kwargs) -> Iterator[Object]:
+        if bucket_name not in self.buckets:
+            raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+        with self.lock:
+            names = sorted((name, (len(content), hashlib.md5(content).hexdigest()))
+                           for ((bucket, name), (content, _)) in self.objects.items() if bucket == bucket_name)
+        return _list(bucket_name, iter(names), prefix, recursive)
+
+
+class MappedResponse:
+    """Readable view of a memory mapped file."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # Empty files cannot be mapped
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.data) if size is None or size < 0 else min(self.position + size, len(self.data))
+        data = self.data[self.position:end]
+        self.position = end
+        return data
+
+    def stream(self, amt: int = CHUNK_SIZE) -> Iterator[bytes]:
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def release_conn(self) -> None:
+        pass
+
+
+class LocalStorage(Storage):
+    """Buckets as directories under root, objects as files read through mmap.
+
+    Metadata of every object (user metadata, content type, etag) is a JSON file under
+    root/.metadata. Objects are written to a temporary file and renamed, so readers never
+    see a partial object; metadata is written after the data.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _bucket_path(self, bucket_name: str) -> str:
+        return os.path.join(self.root, bucket_name)
+
+    def _paths(self, bucket_name: str, object_name: str) -> Tuple[str, str]:
+        if object_name.startswith("/") or ".." in object_name.split("/"):
+            raise ValueError(f"Invalid object name {object_name}")
+        return (os.path.join(self.root, bucket_name, object_name),
+                os.path.join(self.root, METADATA_DIR, bucket_name, object_name + ".json"))
+
+    def _check(self, bucket_name: str, object_name: str) -> Tuple[str, str]:
+        path, metadata_path = self._paths(bucket_name, object_name)
+        if not os.path.isfile(path):
+            if not self.bucket_exists(bucket_name):
+                raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+            raise _error("NoSuchKey", "Object does not exist", bucket_name, object_name)
+        return (path, metadata_path)
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return os.path.isdir(self._bucket_path(bucket_name))
+
+    def make_bucket(self, bucket_name: str) -> None:
+        try:
+            os.mkdir(self._bucket_path(bucket_name))
+        except FileExistsError:
+            raise _error("BucketAlreadyOwnedByYou", "Bucket already exists", bucket_name)
+
+    def _write_atomic(self, path: str, chunks: Iterator[bytes]) -> str:
+        """Writes chunks to path through a renamed temporary file, returns their md5."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        md5 = hashlib.md5()
+        descriptor, staging = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".staging-")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                for chunk in chunks:
+                    md5.update(chunk)
+                    f.write(chunk)
+            os.replace(staging, path)
+        except BaseException:
+            os.unlink(staging)
+            raise
+        return md5.hexdigest()
+
+    def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream", metadata=None, part_size=0, **kwargs) -> None:
+        if not self.bucket_exists(bucket_name):
+            raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+        path, metadata_path = self._paths(bucket_name, object_name)
+
+        def chunks():
+            remaining = length
+            while remaining != 0:
+                chunk = data.read(CHUNK_SIZE if remaining < 0 else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk) if remaining > 0 else 0
+                yield chunk
+
+        etag = self._write_atomic(path, chunks())
+        stored = {"etag": etag, "content-type": content_type, "metadata": _user_metadata(metadata)}
+        self._write_atomic(metadata_path, iter([json.dumps(stored).encode("utf-8")]))
+
+    def get_object(self, bucket_name, object_name, **kwargs) -> MappedResponse:
+        path, _ = self._check(bucket_name, object_name)
+        return MappedResponse(path)
+
+    def _stored(self, metadata_path: str) -> Dict[str, Dict[str, str]]:
+        try:
+            with open(metadata_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # Object copied into the directory by hand
+            return {"etag": None, "content-type": "application/octet-stream", "metadata": {}}
+
+    def stat_object(self, bucket_name, object_name, **kwargs) -> Object:
+        path, metadata_path = self._check(bucket_name, object_name)
+        stored = self._stored(metadata_path)
+        stat = os.stat(path)
+        etag = stored["etag"]
+        if etag is None:
+            with open(path, "rb") as f:
+                etag = hashlib.md5(f.read()).hexdigest()
+        return Object(bucket_name, object_name, last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc), etag=etag,
+                      size=stat.st_size, metadata={**stored["metadata"], "content-type": stored["content-type"]},
+                      content_type=stored["content-type"])
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, **kwargs) -> Iterator[Object]:
+        bucket_path = self._bucket_path(bucket_name)
+        if not os.path.isdir(bucket_path):
+            raise _error("NoSuchBucket", "Bucket does not exist", bucket_name)
+        names = []
+        for (directory, _, files) in os.walk(bucket_path):
+            for filename in files:
+                if filename.startswith(".staging-"):
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, bucket_path).replace(os.sep, "/")
+                names.append((name, (os.path.getsize(path), None)))
+        return _list(bucket_name, iter(sorted(names)), prefix, recursive)
+
+
+STORAGE_BACKENDS = ["minio", "local", "memory"]
+
+
+def get_storage_backend() -> str:
+    backend = os.environ.get("STORAGE_BACKEND", STORAGE_DEFAULT_BACKEND)
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend}, expected one of {STORAGE_BACKENDS}")
+    return backend
+
+
+def get_storage_path() -> str:
+    return os.environ.get("STORAGE_PATH", STORAGE_DEFAULT_PATH)
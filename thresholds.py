@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+import minio_communication
+from consts import *
+from election_data import Committy, ElectionData
+from transform import (
+    ALL_METHODS, APPORTIONMENT_METHODS, Apportionment, OUTPUT_FORMATS, expand_methods, load_election_data,
+    select_method, supports_seats_batch, write_df_to_minio,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class ThresholdRule:
+    """Percentages of national votes needed by regular, coalition and minority committies."""
+    regular: float = 5
+    coalition: float = 8
+    minority: float = 0
+
+    def threshold(self, committy: Committy) -> float:
+        if committy.minority:
+            return self.minority
+        if committy.coalition:
+            return self.coalition
+        return self.regular
+
+
+def threshold_grid(regular: Sequence[float], coalition: Sequence[float], minority: Sequence[float] = (0,)) -> List[ThresholdRule]:
+    """Every combination of the given thresholds."""
+    return [ThresholdRule(float(r), float(c), float(m)) for r in regular for c in coalition for m in minority]
+
+
+def threshold_range(start: float, stop: float, step: float) -> List[float]:
+    """Thresholds from start to stop inclusive, rounded so that 0.1 steps do not drift."""
+    count = int(round((stop - start) / step)) + 1
+    return [round(start + i * step, 10) for i in range(count)]
+
+
+def sweep_methods(methods: List[str]) -> List[str]:
+    """Methods of the sweep; 'all' means every batch method with its own thresholds, as variants only changing
+    thresholds would repeat the same rows."""
+    if ALL_METHODS in methods:
+        variants = {cls.name() for cls in APPORTIONMENT_METHODS if cls.threshold is not Apportionment.threshold}
+        return [method for method in expand_methods(methods) if supports_seats_batch(method) and method not in variants]
+    for method in methods:
+        if not supports_seats_batch(method):
+            raise NotImplementedError(f"{method} does not support threshold sweeps")
+    return list(dict.fromkeys(methods))
+
+
+def qualifying_sets(data: ElectionData, rules: List[ThresholdRule]):
+    """Committies passing every rule, deduplicated.
+
+    Returns the sets x committies masks and the index of the set of every rule.
+    """
+    national = data.national_votes()
+    shares = 100 * national / data.total_valid_votes
+    thresholds = np.array([[rule.threshold(committy) for committy in data.committies] for rule in rules], dtype=float)
+    masks = shares[None, :] >= thresholds.reshape(len(rules), len(data.committies))
+    unique, inverse = np.unique(masks, axis=0, return_inverse=True)
+    return (unique, inverse.reshape(-1))
+
+
+def sweep(data: ElectionData, methods: List[str], rules: List[ThresholdRule]) -> pd.DataFrame:
+    """Seats of every committy for every method and threshold rule.
+
+    Rules letting the same committies through share one allocation: every distinct set is
+    evaluated once, all sets of a method in a single seats_batch call.
+    Thresholds of the rules replace the thresholds of the methods.
+    Returns a tidy table with a row for every method, rule and committy.
+    """
+    masks, set_of_rule = qualifying_sets(data, rules)
+    votes = data.votes.astype(float)[None, :, :] * masks[:, None, :]
+    seats = np.array(data.seats, dtype=int)
+    comitties = data.committy_names
+
+    rule_columns = {
+        'threshold': [rule.regular for rule in rules],
+        'coalition threshold': [rule.coalition for rule in rules],
+        'minority threshold': [rule.minority for rule in rules],
+    }
+    tables = []
+    for method in methods:
+        national_seats = select_method(method).seats_batch(votes, seats).sum(axis=1)
+        tables.append(pd.DataFrame({
+            'method': method,
+            **{name: np.repeat(values, len(comitties)) for (name, values) in rule_columns.items()},
+            'party': np.tile(comitties, len(rules)),
+            'qualifies': masks[set_of_rule].ravel(),
+            'seats': national_seats[set_of_rule].ravel(),
+        }))
+    return pd.concat(tables, ignore_index=True)
+
+
+def sweep_obj_name(output_format: str = "csv") -> str:
+    return f"threshold-sweep.{output_format}"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, choices=YEARS, default=2023,
+                        help='year to analyze')
+    parser.add_argument('--apportionment', type=str, nargs='+', default=[ALL_METHODS],
+                        help=f'apportionments to sweep, "{ALL_METHODS}" runs every method supporting batches')
+    parser.add_argument('--threshold', type=float, nargs=3, default=[0, 10, 0.1], metavar=('START', 'STOP', 'STEP'),
+                        help='thresholds of regular committies')
+    parser.add_argument('--coalition-threshold', type=float, nargs=3, default=[0, 10, 1], metavar=('START', 'STOP', 'STEP'),
+                        help='thresholds of coalition committies')
+    parser.add_argument('--minority-threshold', type=float, nargs='+', default=[0],
+                        help='thresholds of minority committies')
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default="csv",
+                        help='format of the sweep table')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    methods = sweep_methods(program_args.apportionment)
+    rules = threshold_grid(threshold_range(*program_args.threshold), threshold_range(*program_args.coalition_threshold),
+                           program_args.minority_threshold)
+
+    minio_client = minio_communication.get_client()
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(program_args.year)
+    data = load_election_data(minio_client, program_args.year)
+
+    print(f"Sweeping {len(rules)} threshold rules of {len(methods)} methods for {program_args.year}")
+    table = sweep(data, methods, rules)
+
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+    write_df_to_minio(minio_client, bucket_configuration.transformed_data_bucket, sweep_obj_name(program_args.output_format),
+                      table, program_args.output_format)
+
+
+if __name__ == "__main__":
+    main()
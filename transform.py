@@ -1,16 +1,100 @@
 #!/usr/bin/env python
 
+from __future__ import annotations
+
 import argparse
+import contextlib
+import hashlib
 import io
 import json
-import minio
+import os
+import socket
+import socketserver
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Tuple
-import pandas as pd
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
 
+import instrumentation
 import minio_communication
+from election_data import Committy, ElectionData, cached_election_data_path, load_cached
+from reallocation import HARE_NIEMEYER, reallocate
+from vote_weight import district_weights, location_boost, weighted_totals
 from DivisorMethods import * 
 from consts import *
+from lazy_import import lazy_import
+
+# Tables and storage clients are imported on first use, help, validation
+# and runs with every result up to date do not import pandas at all
+minio = lazy_import("minio")
+pd = lazy_import("pandas")
+pa = lazy_import("pyarrow")
+normalize = lazy_import("normalize")
+areas = lazy_import("areas")
+
+# Results election data is built from, constituency results or ones summed from partitioned areas
+CONSTITUENCIES_LEVEL = "constituencies"
+DATA_LEVELS = [CONSTITUENCIES_LEVEL, "gminas", "stations"]
+
+
+def results_columns(year, columns) -> List[str]:
+    """Columns of raw results used for election data, from the total of valid votes on."""
+    idx = RESULTS_FIRST_COLUMN_BY_YEAR.get(year, RESULTS_FIRST_COLUMN_BY_YEAR[2023])
+    return list(columns)[idx:]
+
+
+def districts_columns(year, columns) -> List[str]:
+    """Columns of raw constituences information used for election data."""
+    idxs = DISTRICTS_COLUMNS_BY_YEAR.get(year, DISTRICTS_COLUMNS_BY_YEAR[2023])
+    return [list(columns)[i] for i in idxs]
+
+
+def prepare_election_data(year, results, districts) -> ElectionData:
+    """Joins raw results with constituences information into election data."""
+
+    # Data from https://wybory.gov.pl/sejmsenat2023/pl/dane_w_arkuszach
+    # te dwa ready to argumenty z minio
+    ed = join_election_data(results[results_columns(year, results.columns)], districts[districts_columns(year, districts.columns)])
+    return ElectionData.from_frame(year, ed)
+
+
+def join_election_data(results, districts) -> pd.DataFrame:
+    """Joins results and constituences information already limited to the used columns."""
+    parties = results.fillna(0).set_index([pd.Index(range(1, len(results) + 1))])
+    constituences = districts.set_index('Numer okręgu')
+
+    # Joining results with constituences information
+    return constituences.join(parties)
+
+
+def constituencial_seats_batch(votes, seats, method) -> np.ndarray:
+    """Divisor method applied in every constituency of every scenario."""
+    scenarios, _, comitties = votes.shape
+    result = apportion_batch(votes.reshape(-1, comitties), np.tile(seats, scenarios), method)
+    return result.reshape(votes.shape)
+
+
+def global_seats_batch(votes, seats, method) -> np.ndarray:
+    """Divisor method applied to national totals of every scenario."""
+    scenarios = votes.shape[0]
+    result = apportion_batch(votes.sum(axis=1), np.full(scenarios, np.sum(seats)), method)
+    return result[:, None, :]
+
+
+def sensitivity_table(votes, seats, units, comitties, method) -> pd.DataFrame:
+    """Votes every committy needs to gain or lose one seat in every unit, empty where impossible."""
+    sensitivity = seat_sensitivity(votes, seats, method)
+    table = pd.DataFrame({
+        'unit': np.repeat(units, len(comitties)),
+        'party': np.tile(comitties, len(units)),
+        'seats': sensitivity.seats.ravel(),
+        'votes to gain': sensitivity.votes_to_gain.ravel(),
+        'votes to lose': sensitivity.votes_to_lose.ravel(),
+    })
+    for column in ['votes to gain', 'votes to lose']:
+        table[column] = table[column].replace(np.inf, np.nan).astype('Int64')
+    return table
 
 
 class Apportionment(ABC):
@@ -23,47 +107,63 @@ class Apportionment(ABC):
 
     def load_data(self, year, results, districts) -> None:
         """Loads the data about the results of the elections."""
+        self.set_election_data(prepare_election_data(year, results, districts))
 
-        # Data from https://wybory.gov.pl/sejmsenat2023/pl/dane_w_arkuszach
-        # te dwa ready to argumenty z minio
-        df = results.fillna(0)
-        idx = 23 if year == 2019 else 25
-        idxs = [1,2,6,0] if year == 2019 else [0,1,5,6]
-        parties = pd.concat([df, df.apply(['sum'])]).iloc[:, idx:].set_index([pd.Index(range(1, CONSTITUENCIES + 2))])
-        constituences = districts.iloc[:, idxs].set_index('Numer okręgu')
-
-        # Joining results with constituences information
-        ed = constituences.join(parties) # election data
-        ed = pd.concat([ed, ed.apply(['sum'])]) #tofix string concat 
+    def set_election_data(self, data: ElectionData) -> None:
+        """Uses election data built once per year, possibly shared with other methods."""
 
         # Calculating which comitties pass the threshold
-        comitties = [ele for ele in list(ed.columns) if 'KOMITET' in ele]
-        comitties = [ele for ele in comitties if self.pass_threshold(ele, ed)]
+        national = data.national_votes()
+        passing = [i for (i, committy) in enumerate(data.committies) if self.pass_threshold(committy, national[i], data)]
 
-        self.SEATS = ed.loc['sum']['Liczba mandatów']
-        self.VOTES = ed.loc['sum']['Liczba głosów ważnych oddanych łącznie na wszystkie listy kandydatów']
-        self.comitties = comitties
-        self.ed = ed
+        self.SEATS = data.total_seats
+        self.VOTES = data.total_valid_votes
+        self.comitties = [data.committies[i].name for i in passing]
+        self.columns = passing
+        self.data = data
 
     # Checking if given party can participate in seats allocation
+    def pass_threshold(self, committy: Committy, votes, data: ElectionData) -> bool:
+        supp_share = 100 * votes / data.total_valid_votes
+        return self.threshold(committy) <= supp_share
+
+    # Percentage of national votes needed by given party
     # Default polish threshold, can be overriden in child classes
-    def pass_threshold(self, committy, ed) -> bool:
-        supp_share = 100 * ed.loc['sum'][committy] / ed.loc['sum']['Liczba głosów ważnych oddanych łącznie na wszystkie listy kandydatów']
+    def threshold(self, committy: Committy) -> float:
         threshold = 5 # Regular Committy
-        if 'KOALICYJNY' in committy: 
+        if committy.coalition:
             threshold = 8 # Coalition Committy
-        if 'MNIEJSZOŚĆ' in committy:
+        if committy.minority:
             threshold = 0 # Minority Commity
-        return threshold <= supp_share
+        return threshold
 
     # Reads voting results from one constituency
     def read_constituency_info(self, id): 
-        row = self.ed.loc[id]
-        cname = row['Siedziba OKW']
-        seats = row['Liczba mandatów']
-        data = [(name, row[name]) for name in self.comitties]
+        row = id - 1
+        cname = self.data.district_names[row]
+        seats = int(self.data.seats[row])
+        data = [(name, int(votes)) for (name, votes) in zip(self.comitties, self.data.votes[row, self.columns])]
         return (data, seats, cname)
 
+    # Reads national results of comitties
+    def read_national_info(self):
+        return [(name, int(votes)) for (name, votes) in zip(self.comitties, self.data.national_votes()[self.columns])]
+
+    # Reads national results of comitties as one unit
+    def read_national_matrix(self):
+        votes = self.data.national_votes()[None, self.columns].astype(float)
+        return (votes, np.array([self.SEATS], dtype=int), ['national'])
+
+    def constituency_units(self, cnames) -> List[str]:
+        return [f"C-{id} ({cname})" for (id, cname) in zip(range(1, len(cnames) + 1), cnames)]
+
+    # Reads voting results from all constituencies at once
+    # as constituencies x comitties vote matrix and seat vector
+    def read_constituencies_matrix(self):
+        votes = self.data.votes[:, self.columns].astype(float)
+        seats = np.array(self.data.seats, dtype=int)
+        return (votes, seats, list(self.data.district_names))
+
     @abstractmethod
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
         """Calculates the results of the elections.
@@ -75,6 +175,23 @@ class Apportionment(ABC):
         pass
 
 
+    def sensitivity(self) -> Optional[pd.DataFrame]:
+        """Votes each committy needs to gain or lose a seat, None if the method does not support it."""
+        return None
+
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        """Calculates seats for a batch of vote scenarios without touching the election data.
+
+        Args:
+            votes: scenarios x constituencies x committies matrix, committies below the threshold zeroed.
+            seats: number of seats in each constituency.
+
+        Returns:
+            np.ndarray: scenarios x units x committies seats, where units are constituencies
+            or a single national unit for global methods.
+        """
+        raise NotImplementedError(self.name())
+
     @staticmethod
     def encode_number_of_seats_in_df(seats) -> pd.DataFrame:
         if isinstance(seats, dict):
@@ -88,11 +205,35 @@ class ConstituencialDHondt(Apportionment):
     def name() -> str:
         return "constituencial-dhondt"
 
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        return constituencial_seats_batch(votes, seats, DHONDT)
+
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
+        votes, seats, cnames = self.read_constituencies_matrix()
+        result = apportion_batch(votes, seats, DHONDT)
+        winners, runners_up = last_seats_batch(votes, seats, DHONDT)
+
+        sum_parties = dict(zip(self.comitties, result.sum(axis=0).tolist()))
+        last_seat_data = {}
+        for id in range(1, len(self.data.seats) + 1):
+            row = id - 1
+            last_win_info = None
+            if runners_up[row] >= 0:
+                last_win_info = describe_last_seat(DHONDT, self.comitties, votes[row].tolist(), result[row].tolist(), winners[row], runners_up[row])
+            last_seat_data[f"C-{id} ({cnames[row]})"] = last_win_info
+
+        return (sum_parties, last_seat_data)
+
+    def sensitivity(self) -> Optional[pd.DataFrame]:
+        votes, seats, cnames = self.read_constituencies_matrix()
+        return sensitivity_table(votes, seats, self.constituency_units(cnames), self.comitties, DHONDT)
+
+    # Reference path, allocating every constituency separately
+    def calculate_per_district(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
         sum_parties = dict([(name, 0) for name in self.comitties])
         last_seat_data = {}
 
-        for id in range(1, CONSTITUENCIES + 1):
+        for id in range(1, len(self.data.seats) + 1):
             data, seats, cname = self.read_constituency_info(id)
             result, last_win_info = runDHondt(data, seats)
             for (key, val) in result:
@@ -107,8 +248,8 @@ class ConstituencialDHondtNoThreshold(ConstituencialDHondt):
     def name() -> str:
         return "constituencial-dhondt-no-threshold"
 
-    def pass_threshold(self, committy, ed) -> bool:
-        return True
+    def threshold(self, committy) -> float:
+        return 0
 
 
 class GlobalDHondt(Apportionment): 
@@ -117,8 +258,15 @@ class GlobalDHondt(Apportionment):
         return "global-dhondt"
 
 
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        return global_seats_batch(votes, seats, DHONDT)
+
+    def sensitivity(self) -> Optional[pd.DataFrame]:
+        votes, seats, units = self.read_national_matrix()
+        return sensitivity_table(votes, seats, units, self.comitties, DHONDT)
+
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
-        data_global = [(com, self.ed.loc["sum"][com]) for com in self.comitties]
+        data_global = self.read_national_info()
         result, last_seat_data = runDHondt(data_global, self.SEATS)
         return (result, {"last_seat_data":last_seat_data})
 
@@ -128,8 +276,8 @@ class GlobalDHondtNoThreshold(GlobalDHondt):
     def name() -> str:
         return "global-dhondt-no-threshold"
 
-    def pass_threshold(self, committy, ed) -> bool:
-        return True
+    def threshold(self, committy) -> float:
+        return 0
 
 
 class SquaredDHondt(Apportionment): 
@@ -138,8 +286,13 @@ class SquaredDHondt(Apportionment):
         return "squared-dhondt"
 
 
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        totals = votes.sum(axis=1)
+        sum_votes = totals.sum(axis=1, keepdims=True)
+        return global_seats_batch((totals * (1 + totals / sum_votes))[:, None, :], seats, DHONDT)
+
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
-        data_global = [(com, self.ed.loc["sum"][com]) for com in self.comitties]
+        data_global = self.read_national_info()
         sum_votes = sum(val for (_,val) in data_global)
         data_global_sq = [(com, val * (1 + val/sum_votes)) for (com, val) in data_global]
         result, last_seat_data = runDHondt(data_global_sq, self.SEATS)
@@ -152,10 +305,23 @@ class ConstituencialSainteLague(Apportionment):
         return "constituencial-sainte-lague"
 
 
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        return constituencial_seats_batch(votes, seats, SAINTE_LAGUE)
+
+    def sensitivity(self) -> Optional[pd.DataFrame]:
+        votes, seats, cnames = self.read_constituencies_matrix()
+        return sensitivity_table(votes, seats, self.constituency_units(cnames), self.comitties, SAINTE_LAGUE)
+
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
+        votes, seats, _ = self.read_constituencies_matrix()
+        result = apportion_batch(votes, seats, SAINTE_LAGUE)
+        return (dict(zip(self.comitties, result.sum(axis=0).tolist())), None)
+
+    # Reference path, allocating every constituency separately
+    def calculate_per_district(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
         sum_parties = dict([(name, 0) for name in self.comitties])
 
-        for id in range(1, CONSTITUENCIES + 1):
+        for id in range(1, len(self.data.seats) + 1):
             data, seats, cname = self.read_constituency_info(id)
             result, _ = runSainteLague(data, seats)
             for (key, val) in result:
@@ -169,8 +335,8 @@ class ConstituencialSainteLagueNoThreshold(ConstituencialSainteLague):
     def name() -> str:
         return "constituencial-sainte-lague-no-threshold"
 
-    def pass_threshold(self, committy, ed) -> bool:
-        return True
+    def threshold(self, committy) -> float:
+        return 0
 
 
 class GlobalSainteLague(Apportionment):
@@ -179,8 +345,15 @@ class GlobalSainteLague(Apportionment):
         return "global-sainte-lague"
 
 
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        return global_seats_batch(votes, seats, SAINTE_LAGUE)
+
+    def sensitivity(self) -> Optional[pd.DataFrame]:
+        votes, seats, units = self.read_national_matrix()
+        return sensitivity_table(votes, seats, units, self.comitties, SAINTE_LAGUE)
+
     def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
-        data_global = [(com, self.ed.loc["sum"][com]) for com in self.comitties]
+        data_global = self.read_national_info()
         result, _ = runSainteLague(data_global, self.SEATS)
         return (result, None)  
 
@@ -190,8 +363,8 @@ class GlobalSainteLagueNoThreshold(GlobalSainteLague):
     def name() -> str:
         return "global-sainte-lague-no-threshold"
 
-    def pass_threshold(self, committy, ed) -> bool:
-        return True
+    def threshold(self, committy) -> float:
+        return 0
 
 
 class FairVoteWeightDHondt(Apportionment):
@@ -199,6 +372,14 @@ class FairVoteWeightDHondt(Apportionment):
     def name() -> str:
         return "fair-vote-weight-dhondt"
 
+    # Rule of reallocation.py moving seats between constituencies
+    reallocation_rule = HARE_NIEMEYER
+
+    # Calculation updates seats in the election data, so it works on its own frame
+    def set_election_data(self, data: ElectionData) -> None:
+        super().set_election_data(data)
+        self.ed = data.to_frame()
+
     def calculate(self):
         self.ed['True proportion'] = self.ed['Liczba głosów ważnych oddanych łącznie na wszystkie listy kandydatów'] * self.SEATS / self.VOTES
         self.ed['Voter Strength'] = 100*self.ed['Liczba mandatów'] / self.ed['True proportion'] - 100
@@ -209,8 +390,8 @@ class FairVoteWeightDHondt(Apportionment):
         full_comparison1 = self.ed.sort_values('Voter Strength').iloc[:, [2,0,-2,-1]]
         
         # Updating seat allocation
-        paramHM = self.find_HMpar()
-        self.ed['Liczba mandatów'] = self.ed['True proportion'].apply(lambda x: round(x + paramHM))
+        reallocated = reallocate(self.data.valid_votes, self.SEATS, self.reallocation_rule)
+        self.ed.loc[self.data.district_ids, 'Liczba mandatów'] = reallocated
 
         # Updated voter strength
         self.ed['Voter Strength'] = 100*self.ed['Liczba mandatów'] / self.ed['True proportion'] - 100
@@ -221,128 +402,450 @@ class FairVoteWeightDHondt(Apportionment):
         result2 = (f"Voters in {best['Siedziba OKW']} have vote {round(diff, 4)}x as strong as voters in {worst['Siedziba OKW']}")
         full_comparison2 = self.ed.sort_values('Voter Strength').iloc[:, [2,0,-2,-1]]
 
-        sum_parties = dict([(name, 0) for name in self.comitties])
         extra_data = {}
         extra_data["Vote Strength before"] = result1
         extra_data["Vote Strength after"] = result2 
         extra_data["Full comparison befere"] = full_comparison1.to_dict()
         extra_data["Full comparison after"] = full_comparison2.to_dict()
 
-        for id in range(1, CONSTITUENCIES + 1):
-            data, seats, cname = self.read_constituency_info(id)
-            result, _ = runDHondt(data, seats)
-            for (key, val) in result:
-                sum_parties[key] += val
-        
-        return (sum_parties, extra_data)
-
-    # Hare-Nemayer rounding
-    def find_HMpar(self):
-        low = -1
-        high = 1
-        while True:
-            p = (low + high) / 2 
-            val = self.ed['True proportion'].apply(lambda x: round(x + p)).sum()
-            
-            if val == self.SEATS * 2:
-                return p
-            elif val < self.SEATS * 2:
-                low = p
-            else:
-                high = p
+        votes, _, _ = self.read_constituencies_matrix()
+        result = apportion_batch(votes, reallocated, DHONDT)
+        sum_parties = dict(zip(self.comitties, result.sum(axis=0).tolist()))
 
+        return (sum_parties, extra_data)
 
-def select_method(method: str) -> Apportionment:
-    """Selects the method of counting votes based on the name."""
-    if method == ConstituencialSainteLague.name():
-        return ConstituencialSainteLague()
-    if method == GlobalSainteLague.name():
-        return GlobalSainteLague()
-    if method == ConstituencialDHondt.name():
-        return ConstituencialDHondt()
-    if method == GlobalDHondt.name():
-        return GlobalDHondt()
-    if method == SquaredDHondt.name():
-        return SquaredDHondt()
-    if method == FairVoteWeightDHondt.name():
-        return FairVoteWeightDHondt()
-    if method == ConstituencialSainteLagueNoThreshold.name():
-        return ConstituencialSainteLagueNoThreshold()
-    if method == GlobalSainteLagueNoThreshold.name():
-        return GlobalSainteLagueNoThreshold()
-    if method == ConstituencialDHondtNoThreshold.name():
-        return ConstituencialDHondtNoThreshold()
-    if method == GlobalDHondtNoThreshold.name():
-        return GlobalDHondtNoThreshold()
-    
-    raise NotImplementedError(method)
 
+# National D'Hondt on votes weighted by the votes per seat of their constituencies
+class VoteWeightDHondt(Apportionment):
+    @staticmethod
+    def name() -> str:
+        return "vote-weight-dhondt"
 
-def additional_info_obj_name(apportionment) -> str:
-    return f"{apportionment.name()}-additional-info.json"
+    def seats_batch(self, votes, seats) -> np.ndarray:
+        return global_seats_batch(weighted_totals(votes, district_weights(votes, seats))[:, None, :], seats, DHONDT)
 
+    def calculate(self) -> Tuple[Dict[str, int], Dict[Any, Any]]:
+        votes, seats, cnames = self.read_constituencies_matrix()
+        weights = district_weights(votes, seats)
+        weighted = weighted_totals(votes, weights)
+        result, last_seat_data = runDHondt(list(zip(self.comitties, weighted.tolist())), self.SEATS)
+        return (result, {
+            "last_seat_data": last_seat_data,
+            "weights": dict(zip(cnames, weights.tolist())),
+            "weighted votes": dict(zip(self.comitties, weighted.tolist())),
+            "location boost": dict(zip(self.comitties, location_boost(votes, weighted).tolist())),
+        })
+
+
+APPORTIONMENT_METHODS = [
+    ConstituencialSainteLague,
+    GlobalSainteLague,
+    ConstituencialDHondt,
+    GlobalDHondt,
+    SquaredDHondt,
+    FairVoteWeightDHondt,
+    ConstituencialSainteLagueNoThreshold,
+    GlobalSainteLagueNoThreshold,
+    ConstituencialDHondtNoThreshold,
+    GlobalDHondtNoThreshold,
+    VoteWeightDHondt,
+]
+
+ALL_METHODS = "all"
 
-def seats_obj_name(apportionment) -> str:
-    return f"{apportionment.name()}-seats.csv"
 
+def select_method(method: str) -> Apportionment:
+    """Selects the method of counting votes based on the name."""
+    for cls in APPORTIONMENT_METHODS:
+        if method == cls.name():
+            return cls()
 
-def write_dict_json_to_minio(minio_client, bucket_name, object_name, dict_to_write):
-    json_string_bytes = json.dumps(dict_to_write).encode("utf-8")
-    minio_client.put_object(
-        bucket_name,
-        object_name,
-        io.BytesIO(json_string_bytes),
-        len(json_string_bytes),
-        content_type='application/json'
-    )
+    raise NotImplementedError(method)
 
-def write_csv_bytes_to_minio(minio_client, bucket_name, object_name, df):
-    buffer = io.BytesIO()
-    df.to_csv(buffer, index=False, encoding="utf-8")
 
-    buffer_bytes = buffer.getvalue()
+def supports_seats_batch(method: str) -> bool:
+    return type(select_method(method)).seats_batch is not Apportionment.seats_batch
 
-    minio_client.put_object(bucket_name, object_name,
-                            io.BytesIO(buffer_bytes), len(buffer_bytes), content_type='text/csv')
 
+def expand_methods(methods: List[str]) -> List[str]:
+    """Replaces 'all' with names of every available method, keeping the order and dropping repeats."""
+    names = []
+    for method in methods:
+        for name in ([cls.name() for cls in APPORTIONMENT_METHODS] if method == ALL_METHODS else [method]):
+            if name not in names:
+                names.append(name)
+    return names
 
-def save_results(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, apportionment: Apportionment, seats: Dict[str, int], additional_info: Dict[Any, Any]) -> None:
-    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
 
-    write_dict_json_to_minio(minio_client, bucket_configuration.transformed_data_bucket, additional_info_obj_name(apportionment), additional_info)
-    write_csv_bytes_to_minio(minio_client, bucket_configuration.transformed_data_bucket, seats_obj_name(apportionment), apportionment.encode_number_of_seats_in_df(seats))
+OUTPUT_FORMATS = ["csv", "parquet"]
 
-def load_districts(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year):
-    response = minio_client.get_object(bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year]["districts"])
-    csv_data = pd.read_csv(io.BytesIO(response.read()), sep=";")
-    return csv_data
 
+def additional_info_obj_name(apportionment) -> str:
+    return f"{apportionment.name()}-additional-info.json"
 
-def load_results(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year):
-    response = minio_client.get_object(bucket_configuration.raw_data_bucket, FILENAMES_BY_YEAR[year]["results"])
-    csv_data = pd.read_csv(io.BytesIO(response.read()), sep=";")
-    return csv_data
 
-def parse_args() -> argparse.Namespace:
+def seats_obj_name(apportionment, output_format: str = "csv") -> str:
+    return f"{apportionment.name()}-seats.{output_format}"
+
+
+def sensitivity_obj_name(apportionment, output_format: str = "csv") -> str:
+    return f"{apportionment.name()}-sensitivity.{output_format}"
+
+
+def json_bytes(dict_to_write) -> bytes:
+    return json.dumps(dict_to_write).encode("utf-8")
+
+def df_bytes(df, output_format="csv") -> Tuple[bytes, str]:
+    """Encoded table and its content type."""
+    with instrumentation.span("encode", format=output_format, rows=len(df)) as span:
+        if output_format == "parquet":
+            data, content_type = (normalize.to_parquet_bytes(pa.Table.from_pandas(df, preserve_index=False)), 'application/vnd.apache.parquet')
+        else:
+            buffer = io.BytesIO()
+            df.to_csv(buffer, index=False, encoding="utf-8")
+            data, content_type = (buffer.getvalue(), 'text/csv')
+        span.add(bytes=len(data))
+    return (data, content_type)
+
+def write_dict_json_to_minio(minio_client, bucket_name, object_name, dict_to_write, metadata=None):
+    minio_communication.put_bytes(minio_client, bucket_name, object_name, json_bytes(dict_to_write), 'application/json', metadata)
+
+def write_df_to_minio(minio_client, bucket_name, object_name, df, output_format="csv", metadata=None):
+    data, content_type = df_bytes(df, output_format)
+    minio_communication.put_bytes(minio_client, bucket_name, object_name, data, content_type, metadata)
+
+
+def level_filenames(year, level: str = CONSTITUENCIES_LEVEL) -> Dict[str, str]:
+    """Raw files election data of the level is built from."""
+    if level == CONSTITUENCIES_LEVEL:
+        return FILENAMES_BY_YEAR[year]
+    if level not in AREA_FILENAMES_BY_YEAR.get(year, {}):
+        raise ValueError(f"No {level} results of {year}")
+    return {"districts": FILENAMES_BY_YEAR[year]["districts"], level: AREA_FILENAMES_BY_YEAR[year][level]}
+
+
+def inputs_fingerprint(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year, level: str = CONSTITUENCIES_LEVEL) -> str:
+    """Hash identifying raw inputs of a year, from content hashes recorded by the scraper or object ETags."""
+    identities = {}
+    for (kind, object_name) in sorted(level_filenames(year, level).items()):
+        metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.raw_data_bucket, object_name) or {}
+        identities[kind] = metadata.get("content-sha256", metadata.get("etag"))
+    identity = [year, identities] if level == CONSTITUENCIES_LEVEL else [year, level, identities]
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_up_to_date(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, apportionment, fingerprint: str, output_format: str = "csv") -> bool:
+    """Tells if saved results of the method were calculated from inputs with given fingerprint."""
+    for object_name in [seats_obj_name(apportionment, output_format), additional_info_obj_name(apportionment)]:
+        metadata = minio_communication.get_object_metadata(minio_client, bucket_configuration.transformed_data_bucket, object_name)
+        if metadata is None or metadata.get("inputs-sha256") != fingerprint:
+            return False
+    return True
+
+
+def result_writes(bucket_configuration: minio_communication.MinioBucketConfigurationForYear, apportionment: Apportionment, seats: Dict[str, int], additional_info: Dict[Any, Any], sensitivity: Optional[pd.DataFrame] = None, fingerprint: Optional[str] = None, output_format: str = "csv") -> List[minio_communication.ObjectWrite]:
+    """Objects holding results of a method, in the order they have to be written."""
+    bucket_name = bucket_configuration.transformed_data_bucket
+    metadata = None if fingerprint is None else {"inputs-sha256": fingerprint}
+    writes = []
+    if sensitivity is not None:
+        writes.append(minio_communication.ObjectWrite(bucket_name, sensitivity_obj_name(apportionment, output_format), *df_bytes(sensitivity, output_format), metadata))
+    # Written last, as their metadata marks results as up to date
+    writes.append(minio_communication.ObjectWrite(bucket_name, additional_info_obj_name(apportionment), json_bytes(additional_info), 'application/json', metadata))
+    writes.append(minio_communication.ObjectWrite(bucket_name, seats_obj_name(apportionment, output_format), *df_bytes(apportionment.encode_number_of_seats_in_df(seats), output_format), metadata))
+    return writes
+
+
+def save_results(minio_client: minio.Minio, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, apportionment: Apportionment, seats: Dict[str, int], additional_info: Dict[Any, Any], sensitivity: Optional[pd.DataFrame] = None, fingerprint: Optional[str] = None, output_format: str = "csv", writer: Optional[minio_communication.BatchWriter] = None) -> None:
+    """Writes results of a method, in the background if a writer is given."""
+    with instrumentation.span("save_results", method=apportionment.name()):
+        minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+        writes = result_writes(bucket_configuration, apportionment, seats, additional_info, sensitivity, fingerprint, output_format)
+        if writer is not None:
+            writer.submit(writes)
+            return
+        for write in writes:
+            minio_communication.put_bytes(minio_client, write.bucket_name, write.object_name, write.data, write.content_type, write.metadata)
+
+def load_districts(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year, select=None):
+    """Constituences information, from the normalized parquet if the year was normalized, raw csv otherwise."""
+    data = normalize.load_normalized(minio_client, bucket_configuration, "districts", select)
+    if data is None:
+        data = normalize.load_raw_csv(minio_client, bucket_configuration, year, "districts", select)
+    return data
+
+
+def load_results(minio_client, bucket_configuration: minio_communication.MinioBucketConfigurationForYear, year, select=None, dtype=None):
+    """Results by constituency, from the normalized parquet if the year was normalized, raw csv otherwise.
+
+    dtype only applies to the raw csv, parquet columns are typed already.
+    """
+    data = normalize.load_normalized(minio_client, bucket_configuration, "results", select)
+    if data is None:
+        data = normalize.load_raw_csv(minio_client, bucket_configuration, year, "results", select, dtype)
+    return data
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('--year', type=int, choices=YEARS, default=2023,
-                        help='year to analyze')
-    parser.add_argument('--apportionment', type=str, default=ConstituencialSainteLague.name(),
-                        help='apportionment')
-    return parser.parse_args()
+    parser.add_argument('--year', type=int, nargs='+', choices=YEARS, default=[2023],
+                        help='years to analyze')
+    parser.add_argument('--apportionment', type=str, nargs='+', default=[ConstituencialSainteLague.name()],
+                        help=f'apportionments to run, "{ALL_METHODS}" runs every method')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes calculating (year, method) jobs in parallel')
+    parser.add_argument('--force', action='store_true',
+                        help='recalculate results even if their inputs did not change')
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default="csv",
+                        help='format of seats and sensitivity tables')
+    parser.add_argument('--level', type=str, choices=DATA_LEVELS, default=CONSTITUENCIES_LEVEL,
+                        help='results votes of the constituencies are summed from, gminas and stations as partitioned by ./areas.py')
+    parser.add_argument('--upload-concurrency', type=int, default=minio_communication.get_upload_concurrency(),
+                        help='result objects uploaded and checked at the same time')
+    parser.add_argument('--serve', type=str, default=None, metavar='SOCKET',
+                        help='keep running with imports and election data loaded, doing jobs sent by --connect to this unix socket')
+    parser.add_argument('--connect', type=str, default=None, metavar='SOCKET',
+                        help='send the job to a server started with --serve instead of running it')
+    parser.add_argument('--shutdown', action='store_true',
+                        help='with --connect, stop the server')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+# Election data already mapped by this process, by year and fingerprint,
+# kept warm between the jobs of a server
+_election_data: Dict[Tuple[int, str], ElectionData] = {}
+
+def load_election_data(minio_client, year: int, fingerprint: Optional[str] = None, level: str = CONSTITUENCIES_LEVEL) -> ElectionData:
+    """Election data of a year, built once and memoized on disk by the fingerprint of its raw inputs.
+
+    Votes of the constituencies come from constituency results, or are summed from results of the level.
+    """
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    with instrumentation.span("load_election_data", year=year, level=level) as span:
+        if fingerprint is None:
+            fingerprint = inputs_fingerprint(minio_client, bucket_configuration, year, level)
+        cached = _election_data.get((year, fingerprint)) or load_cached(year, fingerprint)
+        span.add(cache_hit=cached is not None)
+        if cached is not None:
+            _election_data[(year, fingerprint)] = cached
+            return cached
+
+        if level != CONSTITUENCIES_LEVEL:
+            # Cached by areas under its own fingerprint
+            _election_data[(year, fingerprint)] = areas.district_election_data(minio_client, year, level)
+            return _election_data[(year, fingerprint)]
+
+        # Only the used columns are decoded
+        districts = load_districts(minio_client, bucket_configuration, year, lambda columns: districts_columns(year, columns))
+        # Vote counts, missing where a committy did not run
+        results = load_results(minio_client, bucket_configuration, year, lambda columns: results_columns(year, columns), "float64")
+        data = ElectionData.from_frame(year, join_election_data(results, districts))
+        _election_data[(year, fingerprint)] = data.save(cached_election_data_path(year, fingerprint))
+        return _election_data[(year, fingerprint)]
+
+
+def calculate_method(method: str, ed: ElectionData) -> Tuple[Dict[str, int], Dict[Any, Any], Optional[pd.DataFrame]]:
+    with instrumentation.span("calculate", year=ed.year, method=method):
+        apportionment = select_method(method)
+        apportionment.set_election_data(ed)
+        seats, info = apportionment.calculate()
+    with instrumentation.span("sensitivity", year=ed.year, method=method):
+        sensitivity = apportionment.sensitivity()
+    return (seats, info, sensitivity)
+
+
+def pending_methods(minio_client, years: List[int], methods: List[str], force: bool = False, output_format: str = "csv", concurrency: Optional[int] = None,
+                    level: str = CONSTITUENCIES_LEVEL) -> Dict[int, Tuple[str, List[str]]]:
+    """Fingerprint of inputs of every year and methods whose results are missing or outdated.
+
+    Saved results of the methods are checked concurrently, as each check is a few small requests.
+    """
+    pending = {}
+    for year in years:
+        bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+        with instrumentation.span("pending_methods", year=year) as span:
+            fingerprint = inputs_fingerprint(minio_client, bucket_configuration, year, level)
+            if force:
+                outdated = list(methods)
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency or minio_communication.get_upload_concurrency()) as pool:
+                    up_to_date = list(pool.map(lambda method: is_up_to_date(minio_client, bucket_configuration, select_method(method), fingerprint, output_format), methods))
+                outdated = [method for (method, current) in zip(methods, up_to_date) if not current]
+            span.add(methods=len(methods), outdated=len(outdated))
+        for method in methods:
+            if method not in outdated:
+                print(f"Results for {year} {method} are up to date, skipping")
+        if outdated:
+            pending[year] = (fingerprint, outdated)
+    return pending
+
+
+def run_year(minio_client, year: int, methods: List[str], fingerprint: Optional[str] = None, output_format: str = "csv", writer: Optional[minio_communication.BatchWriter] = None,
+             level: str = CONSTITUENCIES_LEVEL) -> None:
+    """Loads data of one year once and runs every given method on it."""
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+    ed = load_election_data(minio_client, year, fingerprint, level)
+
+    for method in methods:
+        print(f"Running transform for {year} {method}")
+        seats, info, sensitivity = calculate_method(method, ed)
+        save_results(minio_client, bucket_configuration, select_method(method), seats, info, sensitivity, fingerprint, output_format, writer)
+
+
+# Election data of every year, sent once to each worker process
+# as the path of its cache, which workers map into memory
+_worker_election_data: Dict[int, ElectionData] = {}
+
+def _init_worker(election_data: Dict[int, ElectionData], instrumented: bool) -> None:
+    _worker_election_data.update(election_data)
+    if instrumented:
+        instrumentation.collect_in_worker()
+
+# Spans of the job travel back with its result
+def _run_job(year: int, method: str) -> Tuple[Tuple[Dict[str, int], Dict[Any, Any], Optional[pd.DataFrame]], List[Dict[str, Any]]]:
+    try:
+        return (calculate_method(method, _worker_election_data[year]), instrumentation.drain())
+    except Exception:
+        instrumentation.drain()
+        raise
+
+
+def run_parallel(minio_client, pending: Dict[int, Tuple[str, List[str]]], workers: int, output_format: str = "csv", writer: Optional[minio_communication.BatchWriter] = None,
+                 level: str = CONSTITUENCIES_LEVEL) -> None:
+    """Calculates every (year, method) job in a process pool and saves results as they come.
+
+    A failing job does not stop the others, failures are reported together at the end.
+    """
+    election_data = {year: load_election_data(minio_client, year, fingerprint, level) for (year, (fingerprint, _)) in pending.items()}
+    errors = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(election_data, instrumentation.enabled())) as executor:
+        jobs = {executor.submit(_run_job, year, method): (year, method) for (year, (_, methods)) in pending.items() for method in methods}
+        for job in as_completed(jobs):
+            year, method = jobs[job]
+            try:
+                (seats, info, sensitivity), spans = job.result()
+            except Exception as e:
+                print(f"Transform for {year} {method} failed: {e!r}")
+                errors.append((year, method, e))
+                continue
+            print(f"Finished transform for {year} {method}")
+            instrumentation.emit(spans)
+            bucket_configuration = minio_communication.get_minio_bucket_configuration(year)
+            save_results(minio_client, bucket_configuration, select_method(method), seats, info, sensitivity, pending[year][0], output_format, writer)
+
+    if errors:
+        failed = ", ".join(f"{year} {method}" for (year, method, _) in errors)
+        raise RuntimeError(f"{len(errors)} of {len(jobs)} transforms failed: {failed}") from errors[0][2]
+
+
+def run_job(argv: List[str], cwd: Optional[str] = None) -> Dict[str, Any]:
+    """Runs transform with the command line arguments in this process, replying with what it printed."""
+    output = io.StringIO()
+    previous_cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            if cwd is not None:
+                os.chdir(cwd)
+            program_args = parse_args(argv)
+            with instrumentation.instrumented(program_args, "transform"):
+                run(program_args)
+        return {"ok": True, "output": output.getvalue()}
+    except SystemExit as e:
+        # Invalid arguments or --help
+        return {"ok": e.code in (0, None), "output": output.getvalue()}
+    except Exception as e:
+        return {"ok": False, "output": output.getvalue(), "error": repr(e)}
+    finally:
+        os.chdir(previous_cwd)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """Reads one request as a JSON line and writes the reply the same way."""
+
+    def handle(self) -> None:
+        request = json.loads(self.rfile.readline())
+        if request.get("shutdown"):
+            self.server.stopped = True
+            reply = {"ok": True, "output": "Server stopped\n"}
+        else:
+            reply = run_job(request["argv"], request.get("cwd"))
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+def serve(socket_path: str) -> None:
+    """Does jobs sent to the unix socket one at a time until asked to stop.
+
+    Modules, the storage client and election data stay loaded between jobs,
+    so a job with cached data only pays for its calculations and uploads.
+    """
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            if probe.connect_ex(socket_path) == 0:
+                raise RuntimeError(f"A server is already running on {socket_path}")
+        # Left by a server that did not stop cleanly
+        os.unlink(socket_path)
+    # Executing the lazily imported modules now rather than in the first job
+    for module in (pd, pa, minio, normalize):
+        module.__name__
+    minio_communication.get_client()
+    server = socketserver.UnixStreamServer(socket_path, _JobHandler)
+    server.stopped = False
+    print(f"Serving transform jobs on {socket_path}", flush=True)
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def submit(socket_path: str, argv: List[str], shutdown: bool = False) -> bool:
+    """Sends a job (or a request to stop) to the server and prints its output, True if the job succeeded."""
+    request = {"shutdown": True} if shutdown else {"argv": argv, "cwd": os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with connection.makefile("rb") as replies:
+            reply = json.loads(replies.readline())
+    print(reply["output"], end="")
+    if "error" in reply:
+        print(reply["error"], file=sys.stderr)
+    return reply["ok"]
+
 
 def main() -> None:
     program_args = parse_args()
-    apportionment = select_method(program_args.apportionment)
+    if program_args.connect is not None:
+        sys.exit(0 if submit(program_args.connect, sys.argv[1:], program_args.shutdown) else 1)
+    if program_args.serve is not None:
+        serve(program_args.serve)
+        return
+    with instrumentation.instrumented(program_args, "transform"):
+        run(program_args)
+
+
+def run(program_args: argparse.Namespace) -> None:
+    methods = expand_methods(program_args.apportionment)
+    # Failing on unknown method before any data is loaded
+    for method in methods:
+        select_method(method)
+    years = list(dict.fromkeys(program_args.year))
+    level = program_args.level
+    for year in years:
+        level_filenames(year, level)
     minio_client = minio_communication.get_client()
-    bucket_configuration = minio_communication.get_minio_bucket_configuration(program_args.year)
+    output_format = program_args.output_format
+    pending = pending_methods(minio_client, years, methods, program_args.force, output_format, program_args.upload_concurrency, level)
 
-    districts = load_districts(minio_client, bucket_configuration, program_args.year)
-    results = load_results(minio_client, bucket_configuration, program_args.year)
+    # Results are uploaded in the background while the next methods are calculated
+    with minio_communication.BatchWriter(minio_client, program_args.upload_concurrency) as writer:
+        if program_args.workers > 1:
+            run_parallel(minio_client, pending, program_args.workers, output_format, writer, level)
+            return
 
-    apportionment.load_data(program_args.year, results, districts)
-    seats, info = apportionment.calculate()
-    save_results(minio_client, bucket_configuration, apportionment, seats, info)
+        for (year, (fingerprint, year_methods)) in pending.items():
+            run_year(minio_client, year, year_methods, fingerprint, output_format, writer, level)
 
 if __name__ == "__main__":
     main()
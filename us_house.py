@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import minio_communication
+from consts import *
+from DivisorMethods import HUNTINGTON_HILL
+from election_data import Committy
+from reallocation import reallocate_batch
+from simulation import NOISES, apply_thresholds, perturb
+from transform import (
+    OUTPUT_FORMATS, ConstituencialSainteLagueNoThreshold, select_method, supports_seats_batch,
+    write_df_to_minio, write_dict_json_to_minio,
+)
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+PARTIES = ["GOP", "Dem"]
+VOTE_SOURCES = ["president", "house"]
+
+# Columns of the parties in the source files, in the order of PARTIES
+HOUSE_SEAT_COLUMNS = ["GOP Seats", "Dem Seats"]
+HOUSE_VOTE_COLUMNS = ["GOP Votes", "Dem Votes"]
+PRESIDENT_VOTE_COLUMNS = ["TRUMP", "HARRIS"]
+
+DC = "District of Columbia"
+STATE_NAMES = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas',
+    'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 'DE': 'Delaware', 'FL': 'Florida', 'GA': 'Georgia',
+    'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana',
+    'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana',
+    'ME': 'Maine', 'MD': 'Maryland', 'MA': 'Massachusetts', 'MI': 'Michigan',
+    'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana',
+    'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey',
+    'NM': 'New Mexico', 'NY': 'New York', 'NC': 'North Carolina', 'ND': 'North Dakota',
+    'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania',
+    'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota',
+    'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont',
+    'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia',
+    'WI': 'Wisconsin', 'WY': 'Wyoming'
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class USElection:
+    """House and presidential results, states in rows and PARTIES in columns.
+
+    DC has electors but no House seats, so it is kept apart from the states.
+    """
+    year: int
+    states: List[str]
+    seats: np.ndarray
+    house_won: np.ndarray
+    house_votes: np.ndarray
+    president_votes: np.ndarray
+    electoral_votes: np.ndarray
+    total_votes: np.ndarray
+    dc_president_votes: np.ndarray
+
+    def votes(self, source: str = "president") -> np.ndarray:
+        if source not in VOTE_SOURCES:
+            raise NotImplementedError(source)
+        return self.president_votes if source == "president" else self.house_votes
+
+
+def _numbers(column: pd.Series) -> np.ndarray:
+    """Counts written with thousands separators, missing counts as 0."""
+    return pd.to_numeric(column.str.replace(",", ""), errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+
+
+def load_us_election(year: int = 2024) -> USElection:
+    files = US_FILENAMES_BY_YEAR[year]
+    house = pd.read_csv(os.path.join(DATA_DIR, files["house"])).sort_values("State", ignore_index=True)
+    president = pd.read_csv(os.path.join(DATA_DIR, files["president"]), dtype=str)
+    # Rows of the states and DC, without the totals and notes below them
+    president.index = president["STATE"].map({**STATE_NAMES, "DC": DC})
+    president = president.loc[president.index.notna()]
+
+    states = house["State"].tolist()
+    missing = [state for state in states if state not in president.index]
+    if missing:
+        raise ValueError(f"No presidential results of {', '.join(missing)}")
+    rows = president.loc[states]
+    return USElection(
+        year=year,
+        states=states,
+        seats=house["Total Seats"].to_numpy(dtype=np.int64),
+        house_won=house[HOUSE_SEAT_COLUMNS].to_numpy(dtype=np.int64),
+        house_votes=house[HOUSE_VOTE_COLUMNS].to_numpy(dtype=np.int64),
+        president_votes=np.stack([_numbers(rows[column]) for column in PRESIDENT_VOTE_COLUMNS], axis=1),
+        electoral_votes=_numbers(rows["ELECTORAL VOTES"]),
+        total_votes=_numbers(rows["TOTAL VOTES"]),
+        dc_president_votes=np.array([_numbers(president.loc[[DC], column])[0] for column in PRESIDENT_VOTE_COLUMNS]),
+    )
+
+
+def load_populations(path: str, states: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Census scenarios from a CSV file with a State column and a column of populations for every scenario.
+
+    Returns names of the scenarios and the scenarios x states matrix.
+    """
+    table = pd.read_csv(path).set_index("State")
+    missing = [state for state in states if state not in table.index]
+    if missing:
+        raise ValueError(f"No population of {', '.join(missing)} in {path}")
+    return ([str(name) for name in table.columns], table.loc[states].to_numpy(dtype=float).T)
+
+
+def perturb_populations(rng: np.random.Generator, populations: np.ndarray, draws: int, sigma: float) -> np.ndarray:
+    """Populations of every scenario grown by independent lognormal factors, draws x scenarios x states."""
+    return np.rint(populations * rng.lognormal(0.0, sigma, size=(draws,) + populations.shape))
+
+
+def apportion_house(populations: np.ndarray, seats: int = US_HOUSE_SEATS) -> np.ndarray:
+    """Huntington-Hill apportionment of the House for every census scenario, every state gets at least one seat.
+
+    populations is a scenarios x states matrix, returns the scenarios x states seats.
+    """
+    return reallocate_batch(np.atleast_2d(populations), seats, HUNTINGTON_HILL.name)
+
+
+def quota_seats(votes: np.ndarray, seats: np.ndarray) -> np.ndarray:
+    """Fractional seats of the parties exactly proportional to their votes in every state."""
+    return seats[..., None] * votes / votes.sum(axis=-1, keepdims=True)
+
+
+def proportional_seats(votes: np.ndarray, seats: np.ndarray, method: str) -> np.ndarray:
+    """Seats of the parties by a batch apportionment method for every census and vote scenario.
+
+    votes is vote scenarios x states x parties, seats census scenarios x states. Parties below
+    the threshold of the method in national votes get no seats, like in simulation.py.
+    Returns census x vote scenarios x units x parties, units being states for constituencial
+    methods and one national unit for global methods.
+    """
+    apportionment = select_method(method)
+    votes = apply_thresholds(votes, np.array([apportionment.threshold(Committy(party, False, False)) for party in PARTIES]))
+    return np.stack([apportionment.seats_batch(votes, state_seats) for state_seats in np.atleast_2d(seats)])
+
+
+def vote_weights(votes: np.ndarray, seats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Votes per seat in every state and the weight of a vote relative to the state with most votes per seat."""
+    per_seat = votes.sum(axis=-1) / seats
+    return (per_seat, per_seat.max(axis=-1, keepdims=True) / per_seat)
+
+
+def electoral_college(votes: np.ndarray, seats: np.ndarray, dc_votes: np.ndarray) -> np.ndarray:
+    """Electors of the parties for every census and vote scenario.
+
+    Every state gives its House seats plus two electors to its winner (Maine and Nebraska
+    split theirs by district in reality), ties go to the party listed first; DC gives its
+    electors to its observed winner. Returns census x vote scenarios x parties.
+    """
+    winners = votes.argmax(axis=-1)[..., None] == np.arange(votes.shape[-1])
+    electors = np.atleast_2d(seats) + US_SENATORS_PER_STATE
+    result = np.einsum("cs,vsp->cvp", electors, winners.astype(np.int64))
+    result[..., int(np.argmax(dc_votes))] += US_DC_ELECTORS
+    return result
+
+
+def state_table(election: USElection, source: str = "president", method: Optional[str] = None,
+                apportioned: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Seats won in every state against the seats proportional to the votes, and the weight of a vote.
+
+    With a constituencial method whole seats of the parties are apportioned in every state too,
+    apportioned are House seats of the states from a census scenario.
+    """
+    votes = election.votes(source)
+    quota = quota_seats(votes, election.seats)
+    per_seat, relative = vote_weights(votes, election.seats)
+    table = pd.DataFrame({"State": election.states, "Total Seats": election.seats})
+    if apportioned is not None:
+        table["Apportioned Seats"] = apportioned
+    table["Electoral Votes"] = election.electoral_votes
+    for (i, party) in enumerate(PARTIES):
+        table[f"{party} Seats"] = election.house_won[:, i]
+    for (i, party) in enumerate(PARTIES):
+        table[f"{party} Votes"] = votes[:, i]
+    for (i, party) in enumerate(PARTIES):
+        table[f"True {party} Seats"] = quota[:, i]
+    if method is not None:
+        proportional = proportional_seats(votes[None], election.seats, method)[0, 0]
+        if len(proportional) == len(election.states):
+            for (i, party) in enumerate(PARTIES):
+                table[f"Proportional {party} Seats"] = proportional[:, i]
+    table["GOP Difference Abs"] = (table["GOP Seats"] - table["True GOP Seats"]).round(4)
+    table["GOP Difference Rel (%)"] = (100 * table["GOP Difference Abs"] / table["Total Seats"]).round(4)
+    table["Votes per Seat"] = per_seat
+    table["Weight Relative"] = relative
+    return table
+
+
+def gerrymandering(table: pd.DataFrame) -> Dict[str, float]:
+    """Seats every party won above its proportional share, summed over the states where it did."""
+    difference = table["GOP Difference Abs"]
+    gop, dem = (round(float(difference.clip(lower=0).sum()), 4), round(float((-difference).clip(lower=0).sum()), 4))
+    return {"GOP extra seats": gop, "Dem extra seats": dem, "GOP difference": round(gop - dem, 4)}
+
+
+def vote_scenarios(election: USElection, source: str, draws: int, batch_size: int, rng: np.random.Generator,
+                   noise: str, concentration: float, swing: float) -> Iterator[np.ndarray]:
+    """Observed votes followed by draws perturbed like in simulation.py, in batches of batch_size."""
+    votes = election.votes(source).astype(float)
+    yield votes[None]
+    for start in range(0, draws, batch_size):
+        yield perturb(rng, votes, min(batch_size, draws - start), noise, concentration, swing)
+
+
+def sweep(election: USElection, census_names: List[str], populations: np.ndarray, votes: Iterator[np.ndarray],
+          method: str) -> pd.DataFrame:
+    """House seats of the parties and electors for every census scenario and vote scenario.
+
+    Seats of the states are apportioned once for all census scenarios, then every batch of
+    vote scenarios is allocated and counted at once for all of them.
+    """
+    seats = apportion_house(populations)
+    tables = []
+    draw = 0
+    for batch in votes:
+        house = proportional_seats(batch, seats, method).sum(axis=2)
+        electors = electoral_college(batch, seats, election.dc_president_votes)
+        census, scenario = np.meshgrid(np.arange(len(census_names)), np.arange(len(batch)), indexing="ij")
+        table = pd.DataFrame({"census": np.asarray(census_names)[census.ravel()], "draw": draw + scenario.ravel()})
+        for (i, party) in enumerate(PARTIES):
+            table[f"{party} House Seats"] = house[..., i].ravel()
+        for (i, party) in enumerate(PARTIES):
+            table[f"{party} Electors"] = electors[..., i].ravel()
+        table["President"] = np.asarray(PARTIES)[electors.argmax(axis=-1).ravel()]
+        tables.append(table)
+        draw += len(batch)
+    return pd.concat(tables, ignore_index=True)
+
+
+def summary(table: pd.DataFrame, scenarios: pd.DataFrame, method: str, source: str) -> Dict[str, Any]:
+    by_census = scenarios.groupby("census", sort=False)
+    return {
+        "method": method,
+        "votes": source,
+        "gerrymandering": gerrymandering(table),
+        "largest vote weight ratio": float(table["Weight Relative"].max()),
+        "census": {
+            str(name): {
+                "draws": int(len(rows)),
+                **{f"{party} mean House seats": float(rows[f"{party} House Seats"].mean()) for party in PARTIES},
+                **{f"{party} House majority probability": float((2 * rows[f"{party} House Seats"] > US_HOUSE_SEATS).mean()) for party in PARTIES},
+                **{f"{party} mean electors": float(rows[f"{party} Electors"].mean()) for party in PARTIES},
+                **{f"{party} president probability": float((rows["President"] == party).mean()) for party in PARTIES},
+            }
+            for (name, rows) in by_census
+        },
+    }
+
+
+def states_obj_name(output_format: str = "csv") -> str:
+    return f"us-house-states.{output_format}"
+
+
+def scenarios_obj_name(output_format: str = "csv") -> str:
+    return f"us-house-scenarios.{output_format}"
+
+
+def summary_obj_name() -> str:
+    return "us-house-summary.json"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--year', type=int, choices=US_YEARS, default=US_YEARS[-1],
+                        help='year of the House election')
+    parser.add_argument('--votes', type=str, choices=VOTE_SOURCES, default="president",
+                        help='votes the proportional seats are counted from')
+    parser.add_argument('--apportionment', type=str, default=ConstituencialSainteLagueNoThreshold.name(),
+                        help='batch method apportioning seats of every state among the parties, with its national threshold')
+    parser.add_argument('--population', type=str, default=None,
+                        help='CSV with a State column and populations of every census scenario, '
+                             'by default states are apportioned by their presidential votes')
+    parser.add_argument('--census-draws', type=int, default=0,
+                        help='perturbed populations added for every census scenario')
+    parser.add_argument('--census-sigma', type=float, default=0.02,
+                        help='spread of the lognormal growth of perturbed populations')
+    parser.add_argument('--draws', type=int, default=0,
+                        help='number of perturbed vote scenarios')
+    parser.add_argument('--batch-size', type=int, default=1_000,
+                        help='vote scenarios allocated at once')
+    parser.add_argument('--noise', type=str, choices=NOISES, default="multinomial",
+                        help='kind of vote perturbation')
+    parser.add_argument('--concentration', type=float, default=1_000,
+                        help='dirichlet concentration, higher is closer to observed shares')
+    parser.add_argument('--swing', type=float, default=2.0,
+                        help='maximal uniform swing in percentage points')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    parser.add_argument('--output-format', type=str, choices=OUTPUT_FORMATS, default="csv",
+                        help='format of the state and scenario tables')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    method = program_args.apportionment
+    if not supports_seats_batch(method):
+        raise NotImplementedError(f"{method} does not support batch apportionment")
+
+    election = load_us_election(program_args.year)
+    rng = np.random.default_rng(program_args.seed)
+    if program_args.population is not None:
+        census_names, populations = load_populations(program_args.population, election.states)
+    else:
+        census_names, populations = (["votes"], election.total_votes[None].astype(float))
+    if program_args.census_draws > 0:
+        drawn = perturb_populations(rng, populations, program_args.census_draws, program_args.census_sigma)
+        census_names = census_names + [f"{name} #{draw + 1}" for draw in range(program_args.census_draws) for name in census_names]
+        populations = np.concatenate([populations, drawn.reshape(-1, populations.shape[1])])
+
+    print(f"Sweeping {len(census_names)} census and {program_args.draws + 1} vote scenarios of {program_args.year}")
+    table = state_table(election, program_args.votes, method, apportion_house(populations[0])[0])
+    votes = vote_scenarios(election, program_args.votes, program_args.draws, program_args.batch_size, rng,
+                           program_args.noise, program_args.concentration, program_args.swing)
+    scenarios = sweep(election, census_names, populations, votes, method)
+
+    minio_client = minio_communication.get_client()
+    bucket_configuration = minio_communication.get_minio_bucket_configuration(program_args.year)
+    minio_communication.create_bucket_if_not_exist(minio_client, bucket_configuration.transformed_data_bucket)
+    write_df_to_minio(minio_client, bucket_configuration.transformed_data_bucket, states_obj_name(program_args.output_format),
+                      table, program_args.output_format)
+    write_df_to_minio(minio_client, bucket_configuration.transformed_data_bucket, scenarios_obj_name(program_args.output_format),
+                      scenarios, program_args.output_format)
+    write_dict_json_to_minio(minio_client, bucket_configuration.transformed_data_bucket, summary_obj_name(),
+                             summary(table, scenarios, method, program_args.votes))
+
+
+if __name__ == "__main__":
+    main()
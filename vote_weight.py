@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+from __future__ import annotations
+
+import argparse
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from lazy_import import lazy_import
+
+# Only needed to read list results
+pd = lazy_import("pandas")
+
+
+LISTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wykaz_list_sejm_2023.csv")
+DISTRICT_COLUMN = 'Numer okręgu'
+COMMITTY_COLUMN = 'Nazwa Komitetu'
+VOTES_COLUMN = 'Liczba głosów'
+SEATS_COLUMN = 'Liczba mandatów'
+QUALIFIED_COLUMN = 'Udział w podziale mandatów'
+
+
+def load_lists(path: str = LISTS_FILE) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+    """Votes of the lists taking part in the allocation from a wykaz_list file.
+
+    Returns the constituencies x committies vote matrix, seats of every constituency,
+    names of the committies and numbers of the constituencies.
+    """
+    lists = pd.read_csv(path, sep=";", encoding="utf-8-sig")
+    lists = lists.loc[lists[QUALIFIED_COLUMN] == 'Tak']
+    districts, district_index = np.unique(lists[DISTRICT_COLUMN].to_numpy(), return_inverse=True)
+    committies, committy_index = np.unique(lists[COMMITTY_COLUMN].to_numpy(dtype=str), return_inverse=True)
+
+    votes = np.zeros((len(districts), len(committies)), dtype=np.int64)
+    np.add.at(votes, (district_index, committy_index), lists[VOTES_COLUMN].to_numpy(dtype=np.int64))
+    seats = np.zeros(len(districts), dtype=np.int64)
+    np.add.at(seats, district_index, lists[SEATS_COLUMN].to_numpy(dtype=np.int64))
+    return (votes, seats, committies.tolist(), districts)
+
+
+def district_weights(votes: np.ndarray, seats: np.ndarray) -> np.ndarray:
+    """Weight of a vote in every constituency: mean votes per seat over the votes per seat of the constituency.
+
+    votes is a (scenarios x) constituencies x committies matrix, only committies taking part in the allocation;
+    votes per seat are truncated to whole votes. Constituencies without seats or votes per seat weigh 0
+    and are left out of the mean. Returns (scenarios x) constituencies weights.
+    """
+    totals = np.asarray(votes).sum(axis=-1)
+    seats = np.broadcast_to(seats, totals.shape)
+    per_seat = np.floor(np.divide(totals, seats, out=np.zeros(totals.shape), where=seats > 0))
+    counted = per_seat > 0
+    mean = per_seat.sum(axis=-1, keepdims=True) / np.maximum(counted.sum(axis=-1, keepdims=True), 1)
+    return np.divide(np.broadcast_to(mean, per_seat.shape), per_seat, out=np.zeros(per_seat.shape), where=counted)
+
+
+def weighted_totals(votes: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """National votes of the committies with every vote counted by the weight of its constituency."""
+    return np.einsum("...c,...cp->...p", weights, np.asarray(votes, dtype=float))
+
+
+def location_boost(votes: np.ndarray, weighted: np.ndarray) -> np.ndarray:
+    """Percent by which the weight of its constituencies boosts every committy, relative to the least boosted one."""
+    ratio = weighted / np.asarray(votes).sum(axis=-2)
+    return 100 * (ratio / ratio.min(axis=-1, keepdims=True) - 1)
+
+
+def report(path: str = LISTS_FILE) -> Dict[str, Dict[str, float]]:
+    votes, seats, committies, _ = load_lists(path)
+    weighted = weighted_totals(votes, district_weights(votes, seats))
+    boost = location_boost(votes, weighted)
+    national = votes.sum(axis=0)
+    return {
+        committy: {"votes": int(national[i]), "weighted votes": round(float(weighted[i])), "location boost": round(float(boost[i]), 4)}
+        for (i, committy) in enumerate(committies)
+    }
+
+
+def test(path: str = LISTS_FILE) -> None:
+    """Checks the vectorized totals against the loop over committies and constituencies of the notebook."""
+    votes, seats, committies, districts = load_lists(path)
+    weights = district_weights(votes, seats)
+    weighted = weighted_totals(votes, weights)
+
+    lists = pd.read_csv(path, sep=";", encoding="utf-8-sig")
+    lists = lists.loc[lists[QUALIFIED_COLUMN] == 'Tak']
+    by_district = lists.groupby(DISTRICT_COLUMN)[[VOTES_COLUMN, SEATS_COLUMN]].sum()
+    index = (by_district[VOTES_COLUMN] / by_district[SEATS_COLUMN]).astype(int)
+    weight = index.mean() / index
+    for (i, committy) in enumerate(committies):
+        expected = 0
+        for number in districts:
+            row = lists[(lists[DISTRICT_COLUMN] == number) & (lists[COMMITTY_COLUMN] == committy)]
+            if not row.empty:
+                expected += weight.loc[number] * row[VOTES_COLUMN].iloc[0]
+        assert round(expected) == round(weighted[i]), (committy, expected, weighted[i])
+
+    # Constituencies without seats or votes weigh nothing instead of poisoning the totals
+    weights = district_weights(np.vstack([votes, np.zeros_like(votes[:1]), votes[:1]]), np.append(seats, [seats[0], 0]))
+    assert np.isfinite(weights).all() and (weights[-2:] == 0).all() and np.allclose(weights[:-2], district_weights(votes, seats))
+
+    print(f"Weighted votes of {len(committies)} committies agree with the loop")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', type=str, default=LISTS_FILE,
+                        help='wykaz_list file with votes of the lists in every constituency')
+    return parser.parse_args()
+
+
+def main() -> None:
+    program_args = parse_args()
+    print("Committy - Votes - Weighted votes - Location boost (%)")
+    for (committy, row) in report(program_args.file).items():
+        print(f"{committy}: {row['votes']} {row['weighted votes']} {row['location boost']}%")
+
+
+if __name__ == "__main__":
+    main()